@@ -2,15 +2,14 @@ from __future__ import print_function
 import util
 import random
 import numpy as np
-from normalization import normalize
-from sys import maxint
-from search import RandomWalkSearch, DepthFirstSearch
-from graph import MarkovChainGraph
-from problem import FindStateProblem
+from normalization import normalize, normalize_many
+from search import RandomWalkSearch, DepthFirstSearch, ShortestPathTable
+from graph import MarkovChainGraph, DotExporter, TransitionLog
+from counters import VisitCounters
 
 class ProblemSolver():
     def __init__(self, discretizer, graph, search, problem, sensorStates, behaviors, graphInputFilename=None, graphOutputFilename=None):
-        normSensorStates = map(normalize, sensorStates)
+        normSensorStates = normalize_many(sensorStates)
         print(normSensorStates[0])
 
         print("Training discretizer")
@@ -18,7 +17,7 @@ class ProblemSolver():
         discretizer.train(normSensorStates)
         print("Done training discretizer")
 
-        discSensorStates = map(discretizer.discretize, normSensorStates)
+        discSensorStates = discretizer.discretize_many(normSensorStates).tolist()
         
         print("Constructing graph")
         self.graph  = graph
@@ -43,7 +42,8 @@ class ProblemSolver():
 
     def action(self, sensorState):
         norm = normalize(sensorState)
-        dis = self.discretizer.discretize(norm)
+        # Use the batch path so the state matches the ones in the graph
+        dis = self.discretizer.discretize_many([norm]).tolist()[0]
         self.sensorStateHistory.append(dis)
         n = self.problem.required_state_sequence_length()
         if self.problem.goal(self.sensorStateHistory[-n:]):
@@ -97,14 +97,15 @@ class RandomCollector():
 
 class SmartCollector():
 
-    def __init__(self, outputFile, discretizer):
+    def __init__(self, outputFile, discretizer, exporter=None, graphLogDirectory=None):
         self.f = outputFile
         self.discretizer = discretizer
         self.behaviors = ["explore", "faceObject", "tryGrab", "release"]
-        self.stateBehaviors = {} # State -> Behavior -> Count
         self.algorithmState = "random"
         self.graph = MarkovChainGraph()
-        self.search = DepthFirstSearch()
+        self.visits = VisitCounters(self.behaviors, self.graph.table) # State id -> Behavior -> Count
+        self.exporter = exporter if exporter is not None else DotExporter()
+        self.paths = ShortestPathTable(self.graph)
         self.randomMoves = 0
         self.randomBehaviors = ["explore"]*80 + ["faceObject"]*10 + ["tryGrab"]*5 + ["release"]*5
         self.sinceLastNewState = 0
@@ -113,6 +114,20 @@ class SmartCollector():
         self.last_search_behavior = None
         self.same_search_behavior = 0
         self.round = 0
+
+        self.log = None
+        if graphLogDirectory is not None:
+            self.log = TransitionLog(graphLogDirectory, self.graph)
+            self.resume()
+
+    def resume(self):
+        '''
+        Rebuild the behavior counts from a graph recovered from its log
+        '''
+        for state_id in range(len(self.graph.table)):
+            self.visits.add(state_id, self.graph.state(state_id),
+                    counts=self.graph.behavior_counts(state_id))
+            self.round += self.visits.total(state_id)
     
     def getInitialState(self, sensorState):
         self.initialState = self.discretizer.discretize(normalize(sensorState))
@@ -121,62 +136,58 @@ class SmartCollector():
     def eventHandler(self, state, sensorState, behaviorResult):
         return self.nextBehavior(sensorState) 
 
-    def selectBehavior(self, stateBehaviors):
-        for b in self.behaviors:
-            if b not in stateBehaviors:
-                return b
-
-        minpair = (maxint, "")
-        for behavior, count in stateBehaviors.iteritems():
-            if count < minpair[0]:
-                minpair = (count, behavior)
-
-        return minpair[1]
+    def selectBehavior(self, state_id):
+        return self.visits.least_explored_behavior(state_id)
     
     def minCountState(self):
-        mincount = maxint
-        minstate = ""
-        for state, behaviors in self.stateBehaviors.iteritems():
-            if mincount > behaviors["count"]:
-                mincount = behaviors["count"]
-                minstate = state
-        return (minstate, mincount)
+        return self.visits.min_state()
+
+    def leastVisited(self, n=1):
+        '''
+        Get the least chosen (state, behavior) pairs, least chosen first
+
+        n: int
+
+        returns: ((string * string) * int) list
+        '''
+        return [ ((self.graph.key(state_id), behavior), count)
+                for (state_id, behavior), count in self.visits.least_visited(n) ]
     
-    def randomBehavior(self, dis, discretized):
-        if self.stateBehaviors[dis]["count"] == 0 or self.randomMoves > 20:
+    def randomBehavior(self, state_id):
+        if self.visits.total(state_id) == 0 or self.randomMoves > 20:
             self.randomMoves = 0
             self.algorithmState = "intelligent"
-            return self.intelligentBehavior(dis, discretized)
+            return self.intelligentBehavior(state_id)
         else:
             self.randomMoves += 1
             return random.choice(self.randomBehaviors)
 
-    def intelligentBehavior(self, dis, discretized):
+    def intelligentBehavior(self, state_id):
         if self.sinceLastNewState > 20:
             self.sinceLastNewState = 0
             self.algorithmState = "random"
-            return self.randomBehavior(dis, discretized)
+            return self.randomBehavior(state_id)
 
-        if self.stateBehaviors[dis]["count"] > (self.minCountState()[1] + 20):
+        if self.visits.total(state_id) > (self.minCountState()[1] + 20):
             self.sinceLastNewState = 0
             self.algorithmState = "search"
             self.goal_state, self.goal_state_count = self.minCountState()
-            return self.searchBehavior(dis, discretized)
+            return self.searchBehavior(state_id)
 
         self.sinceLastNewState += 1
-        return self.selectBehavior(self.stateBehaviors[dis])
+        return self.selectBehavior(state_id)
     
-    def searchBehavior(self, dis, discretized):
-        if dis == self.goal_state or dis not in self.stateBehaviors:
+    def searchBehavior(self, state_id):
+        if state_id == self.goal_state or state_id not in self.visits:
+            self.paths.discard(self.goal_state)
             self.goal_state = None
             self.goal_state_count = None
             self.algorithmState = "intelligent"
-            return self.intelligentBehavior(dis, discretized)
-        problem = FindStateProblem(self.goal_state)
-        behavior, err = self.search.choose_behavior([discretized], self.graph, problem)
+            return self.intelligentBehavior(state_id)
+        behavior = self.paths.next_behavior(state_id, self.goal_state)
 
-        print("Searching for:", self.goal_state)
-        if err <= 0 or self.same_search_behavior > 5:
+        print("Searching for:", self.graph.key(self.goal_state))
+        if behavior is None or self.same_search_behavior > 5:
             print("No path, random")
             self.same_search_behavior = 0
             return random.choice(self.randomBehaviors)
@@ -196,42 +207,39 @@ class SmartCollector():
         print(sensorState, file=self.f)
         normSensorState = normalize(sensorState)
         discretized = self.discretizer.discretize(normSensorState)
-        dis = self.graph.state_to_key(discretized)
+        state_id = self.graph.state_id(discretized)
 
         if self.previous_state is not None and self.previous_behavior is not None:
             self.graph.construct([self.previous_state, discretized],
                     [self.previous_behavior])
+            self.exporter.add(self.round, self.previous_state,
+                    self.previous_behavior, discretized)
 
-        if dis not in self.stateBehaviors:
+        if state_id not in self.visits:
             self.sinceLastNewState = 0
-            self.stateBehaviors[dis] = {}
-            self.stateBehaviors[dis]["count"] = 0
-            self.stateBehaviors[dis]["origin"] = discretized
+            self.visits.add(state_id, discretized, self.round)
 
         behavior = "explore"
         if self.algorithmState == "random":
-            behavior = self.randomBehavior(dis, discretized)
+            behavior = self.randomBehavior(state_id)
         elif self.algorithmState == "intelligent":
-            behavior = self.intelligentBehavior(dis, discretized)
+            behavior = self.intelligentBehavior(state_id)
         elif self.algorithmState == "search":
-            behavior = self.searchBehavior(dis, discretized)
+            behavior = self.searchBehavior(state_id)
 
-
-        if behavior not in self.stateBehaviors[dis]:
-            self.stateBehaviors[dis][behavior] = 0
-
-        self.stateBehaviors[dis][behavior] += 1
-        self.stateBehaviors[dis]["count"] += 1
-        print(self.stateBehaviors)
-        print("State:", dis)
+        self.visits.increment(state_id, behavior)
+        print("State:", self.graph.key(state_id))
         print("Behavior:", behavior)
         print(behavior, file=self.f)
         self.previous_state = discretized
         self.previous_behavior = behavior
-        self.graph.visualize('dot/graph.dot', self.initialState)
-        self.graph.visualize('dot/graph_%d.dot' % self.round, self.initialState)
         return behavior
 
+    def close(self):
+        self.exporter.close()
+        if self.log is not None:
+            self.log.close()
+
 
 class ObjectHomer():
 
@@ -288,7 +296,7 @@ class NaiveCollector():
         self.f = outputFile
         self.discretizer = discretizer
         self.behaviors = ["explore", "faceObject", "tryGrab", "release"]
-        self.stateBehaviors = {}
+        self.visits = VisitCounters(self.behaviors) # State id -> Behavior -> Count
     
     def getInitialState(self, sensorState):
         return self.nextBehavior(sensorState)
@@ -296,33 +304,22 @@ class NaiveCollector():
     def eventHandler(self, state, sensorState, behaviorResult):
         return self.nextBehavior(sensorState) 
 
-    def selectBehavior(self, stateBehaviors):
-        for b in self.behaviors:
-            if b not in stateBehaviors:
-                return b
-
-        minpair = (maxint, "")
-        for behavior, count in stateBehaviors.iteritems():
-            if count < minpair[0]:
-                minpair = (count, behavior)
-
-        return minpair[1]
+    def selectBehavior(self, state_id):
+        return self.visits.least_explored_behavior(state_id)
 
     def nextBehavior(self, sensorState):
         print(sensorState, file=self.f)
         normSensorState = normalize(sensorState)
-        dis = ",".join(map(str, self.discretizer.discretize(normSensorState)))
-
-        if dis not in self.stateBehaviors:
-            self.stateBehaviors[dis] = {}
+        discretized = self.discretizer.discretize(normSensorState)
+        dis = ",".join(map(str, discretized))
+        state_id = self.visits.table.intern(dis, discretized)
 
-        behavior = self.selectBehavior(self.stateBehaviors[dis])
+        if state_id not in self.visits:
+            self.visits.add(state_id, discretized)
 
-        if behavior not in self.stateBehaviors[dis]:
-            self.stateBehaviors[dis][behavior] = 0
+        behavior = self.selectBehavior(state_id)
 
-        self.stateBehaviors[dis][behavior] += 1
-        print(self.stateBehaviors)
+        self.visits.increment(state_id, behavior)
         print(behavior)
         print(behavior, file=self.f)
         return behavior
@@ -1,12 +1,32 @@
 import random
 import time
-from lasso import Lasso
+import threading
+import Queue
+
+# Rear sensor reading above which grab backs off from an object first, and
+# the number of steps in a row grab backs off without the reading dropping
+# below its lowest so far before it gives up, as the robot is blocked
+BACK_OFF_THRESHOLD = 2500
+BACK_OFF_STALLS = 5
+
+def complete(result):
+    '''
+    Wait for a behavior that returned a motion handle, which has no result
+    '''
+    if hasattr(result, 'wait'):
+        result.wait()
+        return None
+    return result
 
 class Behaviors():
 
-    def __init__(self, robot, algorithm):
+    def __init__(self, robot, algorithm, lasso=None, sleep=time.sleep):
+        if lasso is None:
+            from lasso import Lasso
+            lasso = Lasso()
         self.robot = robot 
-        self.lasso = Lasso()
+        self.lasso = lasso
+        self.sleep = sleep
         self.algorithm = algorithm
         self.state = algorithm.getInitialState(self.getSensorState())
         self.terminate = False
@@ -21,20 +41,24 @@ class Behaviors():
             "tryGrab": self.tryGrab,
         }
 
-    def run(self):
+    def run(self, rounds=None):
         behaviorResult = None
-        while not self.terminate:
+        while not self.terminate and rounds != 0:
+            if rounds is not None:
+                rounds -= 1
             self.state = self.algorithm.eventHandler(self.state,
                     self.getSensorState(), behaviorResult)
-            behaviorResult = self.behaviors[self.state]()
+            behaviorResult = complete(self.behaviors[self.state]())
 
-    def getSensorState(self):
+    def getSensorState(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.robot.snapshot()
         return {
-            "frontSensors": self.robot.getFrontSensors(),
-            "groundSensors": self.robot.getGroundSensors(),
-            "rearSensors": self.robot.getRearSensors(),
-            "accelerometer": self.robot.getAccelerometer(),
-            "micIntensity": self.robot.getMicIntensity(),
+            "frontSensors": snapshot.frontSensors,
+            "groundSensors": snapshot.groundSensors,
+            "rearSensors": snapshot.rearSensors,
+            "accelerometer": snapshot.accelerometer,
+            "micIntensity": snapshot.micIntensity,
             "lassoState": self.lasso.getState()
         }
 
@@ -42,24 +66,51 @@ class Behaviors():
         return not self.robot.overEdge()
 
     def grab(self):
+        '''
+        Back up to an object and lower the lasso on it. Returns whether the
+        lasso was lowered, which it is not if the robot could not back off
+        from the object first.
+        '''
         self.lasso.up()
         self.robot.left(10)
         self.robot.backwards(2)
-        while len(filter(lambda x: x > 2500, self.robot.getRearSensors())) > 0:
-            self.robot.forward(0.1)
+        if not self.backOff():
+            return False
         self.lasso.down()
+        return True
+
+    def backOff(self):
+        '''
+        Move forward in small steps until no rear sensor reads above
+        BACK_OFF_THRESHOLD, giving up after BACK_OFF_STALLS steps in a row
+        without progress. Returns whether the robot got clear.
+        '''
+        lowest = max(self.robot.getRearSensors())
+        stalls = 0
+        while lowest > BACK_OFF_THRESHOLD:
+            if stalls == BACK_OFF_STALLS:
+                return False
+            self.robot.forward(0.1)
+            reading = max(self.robot.getRearSensors())
+            if reading < lowest:
+                lowest = reading
+                stalls = 0
+            else:
+                stalls += 1
+        return True
 
     def tryGrab(self):
-        self.grab()
+        if not self.grab():
+            return
         self.robot.forward(5)
-        time.sleep(1.5)
+        self.sleep(1.5)
         if len(filter(lambda x: x > 1000, self.robot.getRearSensors())) == 0:
             self.release()
             return
         
         before_sensors = self.robot.getRearSensors()
         self.robot.forward(1)
-        time.sleep(0.5)
+        self.sleep(0.5)
         after_sensors = self.robot.getRearSensors()
         if len(filter(lambda (x,y): abs(x-y) > 100, zip(before_sensors, after_sensors))) == 0:
             self.release()
@@ -75,24 +126,165 @@ class Behaviors():
 
     def explore(self):
         if len(filter(lambda x: x > 0, self.robot.getFrontSensors())) == 0:
-            random.choice([self.robot.forward]*3 + [self.robot.left, self.robot.right])(2)
+            return random.choice([self.robot.forwardAsync]*3 + [self.robot.leftAsync, self.robot.rightAsync])(2)
         else:
-            self.robot.left(1)
+            return self.robot.leftAsync(1)
 
     def faceObject(self):
         frontSensors = self.robot.getFrontSensors()
         if not max(frontSensors) == frontSensors[2]:
             if frontSensors[1] > frontSensors[3]:
-                self.robot.left(0.25)
+                return self.robot.leftAsync(0.25)
             else:
-                self.robot.right(0.25)
+                return self.robot.rightAsync(0.25)
 
     def identifyMoveableObject(self):
         self.robot.forward(5)
         before = self.robot.getFrontSensors()[2]
-        time.sleep(2)
+        self.sleep(2)
         after = self.robot.getFrontSensors()[2]
         return before-after > 1500
 
     def stop(self):
         self.terminate = True
+
+
+class Planner(threading.Thread):
+    '''
+    A single call of an algorithm's eventHandler on a thread of its own, so
+    the control loop can stop waiting for it at a deadline
+    '''
+
+    def __init__(self, algorithm, state, sensorState, behaviorResult):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.algorithm = algorithm
+        self.args = (state, sensorState, behaviorResult)
+        self.state = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.state = self.algorithm.eventHandler(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.state
+
+
+class PipelinedBehaviors(Behaviors):
+    '''
+    Behaviors with a control loop that overlaps sensing, planning and acting.
+    The robot's sampler senses in the background and an actor thread carries
+    out the current behavior while the algorithm plans the next one on the
+    latest sample, so a decision takes as long as the slowest stage instead
+    of the sum of all of them. Algorithms are called as they are, one call at
+    a time, from a planner thread.
+
+    The price is that a decision is based on the sensor state sampled while
+    the previous behavior is still running, and gets the result of the
+    behavior before that one.
+
+    Every tick has a deadline of period seconds for each stage, and misses
+    are counted in overruns. A sample older than that is replaced by a fresh
+    reading, and if that fails the tick is not planned. Planning gets period
+    seconds plus what is left of the current behavior: if no decision is
+    ready when the actor needs the next behavior, the previous one is
+    repeated, and the late decision is used on a later tick. Acting taking
+    longer is only counted. Sample ages and acting are timed with clock,
+    which must be the one stamping the robot's samples (the virtual clock of
+    a simulated robot).
+    '''
+
+    def __init__(self, robot, algorithm, period=0.5, lasso=None, sleep=time.sleep, clock=time.time):
+        if robot.sampler is None:
+            robot.startSampler()
+        Behaviors.__init__(self, robot, algorithm, lasso, sleep)
+        self.period = period
+        self.clock = clock # Of the sampler's time stamps
+        self.ticks = 0
+        self.fallbacks = 0
+        self.overruns = { "sense": 0, "plan": 0, "act": 0 }
+        self.actions = Queue.Queue(1)
+        self.results = Queue.Queue(1)
+
+    def run(self, rounds=None):
+        actor = threading.Thread(target=self.act)
+        actor.daemon = True
+        actor.start()
+
+        planner = None
+        try:
+            self.actions.put(self.state)
+            behaviorResult = None
+            while not self.terminate and rounds != 0:
+                if planner is None:
+                    sensorState = self.sense()
+                    if sensorState is not None:
+                        planner = Planner(self.algorithm, self.state, sensorState, behaviorResult)
+                if planner is not None:
+                    planner.join(self.period)
+                    if planner.is_alive():
+                        self.overruns["plan"] += 1
+
+                # Wait for the current behavior before starting the next one
+                behaviorResult = self.result()
+                self.ticks += 1
+                if planner is not None and not planner.is_alive():
+                    state = planner.result()
+                    planner = None
+                    if rounds is not None:
+                        rounds -= 1
+                else:
+                    # No decision in time, repeat the previous behavior
+                    state = self.state
+                    self.fallbacks += 1
+                self.state = state
+                if not self.terminate:
+                    self.actions.put(state)
+        finally:
+            if planner is not None:
+                planner.join()
+            self.actions.put(None)
+            actor.join()
+
+    def sense(self):
+        '''
+        Get the sensor state to plan on: the latest sample, or a fresh
+        reading if the sample missed its deadline. Returns None if the
+        reading fails too.
+        '''
+        sampled, snapshot = self.robot.sampler.history()[-1]
+        if self.clock() - sampled <= self.period:
+            return self.getSensorState(snapshot)
+
+        self.overruns["sense"] += 1
+        try:
+            return self.getSensorState(self.robot.fetchSnapshot())
+        except Exception as e:
+            print("Sensing failed: %s" % e)
+            return None
+
+    def act(self):
+        while True:
+            state = self.actions.get()
+            if state is None:
+                return
+            t = self.clock()
+            try:
+                result = (True, complete(self.behaviors[state]()))
+            except Exception as e:
+                result = (False, e)
+            if self.clock() - t > self.period:
+                self.overruns["act"] += 1
+            self.results.put(result)
+
+    def result(self):
+        ok, result = self.results.get()
+        if not ok:
+            raise result
+        return result
@@ -0,0 +1,214 @@
+import numpy as np
+from graph import StateTable
+
+class MinCountIndex():
+    '''
+    Visit counts of keys, bucketed by count so the least visited keys are
+    found without scanning: adding a key, incrementing its count and asking
+    for the minimum are O(1). Counts only ever grow by one.
+    '''
+
+    def __init__(self):
+        self.counts = {}   # Key -> Count
+        self.buckets = {}  # Count -> Set of keys
+        self.min_count = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def count(self, key):
+        return self.counts[key]
+
+    def add(self, key, count=0):
+        '''
+        Start counting a new key from the given count
+
+        key: hashable
+        count: int
+
+        returns: None
+        '''
+        if key in self.counts:
+            raise Exception('Key already counted: %s' % (key,))
+        self.counts[key] = count
+        self.buckets.setdefault(count, set()).add(key)
+        if self.min_count is None or count < self.min_count:
+            self.min_count = count
+
+    def increment(self, key):
+        '''
+        Count a visit of a key, adding it first if needed
+
+        key: hashable
+
+        returns: int, the new count
+        '''
+        if key not in self.counts:
+            self.add(key)
+
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        bucket.remove(key)
+        if len(bucket) == 0:
+            del self.buckets[count]
+            if self.min_count == count:
+                # The key itself is now the least visited
+                self.min_count = count + 1
+
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, set()).add(key)
+        return count + 1
+
+    def min(self):
+        '''
+        Get one of the least visited keys
+
+        returns: hashable * int, the key and its count, or None if empty
+        '''
+        if self.min_count is None:
+            return None
+        return next(iter(self.buckets[self.min_count])), self.min_count
+
+    def least(self, n=None):
+        '''
+        Get the least visited keys, least visited first
+
+        n: int, the number of keys, or None for all of them
+
+        returns: (hashable * int) list
+        '''
+        least = []
+        for count in sorted(self.buckets):
+            for key in self.buckets[count]:
+                if n is not None and len(least) == n:
+                    return least
+                least.append( (key, count) )
+        return least
+
+
+class StateRecord(object):
+    '''
+    What a VisitCounters knows about a state besides its counts
+    '''
+    __slots__ = ['origin', 'discovered']
+
+    def __init__(self, origin, discovered):
+        self.origin = origin          # The discretized state
+        self.discovered = discovered  # Round the state was first seen
+
+
+class VisitCounters():
+    '''
+    Counts of the behaviors chosen in each state, stored densely: row i of
+    counts holds the count of every behavior in the state with id i, then
+    their total. State ids are those of a StateTable, which may be shared
+    with a graph. The array grows by doubling, so memory is a fixed number
+    of bytes per state. An index over the totals finds the least visited
+    state in O(1), another over the (state id, behavior id) pairs the least
+    chosen pairs without sorting the array.
+    '''
+
+    def __init__(self, behaviors, table=None, capacity=64):
+        self.behaviors = list(behaviors)
+        self.behavior_ids = dict( (b, i) for i, b in enumerate(self.behaviors) )
+        self.table = table if table is not None else StateTable()
+        self.counts = np.zeros( (capacity, len(self.behaviors) + 1), dtype=np.int64 )
+        self.records = [None] * capacity  # State id -> StateRecord
+        self.index = MinCountIndex()      # State id -> Total
+        self.pairs = MinCountIndex()      # (State id, Behavior id) -> Count
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, state_id):
+        return state_id < len(self.records) and self.records[state_id] is not None
+
+    def add(self, state_id, origin, discovered=0, counts=None):
+        '''
+        Start counting the behaviors of a state
+
+        state_id: int
+        origin: float list
+        discovered: int
+        counts: dict of string -> int, initial counts, or None
+
+        returns: None
+        '''
+        if state_id >= len(self.records):
+            capacity = max(state_id + 1, 2 * len(self.records))
+            counts_array = np.zeros( (capacity, self.counts.shape[1]), dtype=np.int64 )
+            counts_array[:len(self.counts)] = self.counts
+            self.counts = counts_array
+            self.records += [None] * (capacity - len(self.records))
+
+        self.records[state_id] = StateRecord(origin, discovered)
+        if counts is not None:
+            for behavior, count in counts.iteritems():
+                self.counts[state_id, self.behavior_ids[behavior]] = count
+            self.counts[state_id, -1] = sum(counts.values())
+        self.index.add(state_id, int(self.counts[state_id, -1]))
+        for behavior_id in range(len(self.behaviors)):
+            self.pairs.add( (state_id, behavior_id), int(self.counts[state_id, behavior_id]) )
+
+    def increment(self, state_id, behavior):
+        '''
+        Count a behavior chosen in a state
+
+        state_id: int
+        behavior: string
+
+        returns: None
+        '''
+        behavior_id = self.behavior_ids[behavior]
+        self.counts[state_id, behavior_id] += 1
+        self.counts[state_id, -1] += 1
+        self.index.increment(state_id)
+        self.pairs.increment( (state_id, behavior_id) )
+
+    def count(self, state_id, behavior):
+        return int(self.counts[state_id, self.behavior_ids[behavior]])
+
+    def total(self, state_id):
+        return int(self.counts[state_id, -1])
+
+    def record(self, state_id):
+        return self.records[state_id]
+
+    def behavior_counts(self, state_id):
+        '''
+        Get the counts of the behaviors in a state, as a dict
+
+        returns: dict of string -> int
+        '''
+        return dict(zip(self.behaviors, self.counts[state_id, :-1].tolist()))
+
+    def least_explored_behavior(self, state_id):
+        '''
+        Get the least chosen behavior of a state, the first one on ties (so
+        the first behavior never chosen, if any)
+
+        returns: string
+        '''
+        return self.behaviors[int(np.argmin(self.counts[state_id, :-1]))]
+
+    def min_state(self):
+        '''
+        Get one of the least visited states
+
+        returns: int * int, the state id and its total, or None if empty
+        '''
+        return self.index.min()
+
+    def least_visited(self, n=1):
+        '''
+        Get the least chosen (state id, behavior) pairs, least chosen first
+
+        n: int
+
+        returns: ((int * string) * int) list
+        '''
+        return [ ((state_id, self.behaviors[behavior_id]), count)
+                for (state_id, behavior_id), count in self.pairs.least(n) ]
@@ -1,21 +1,322 @@
-import sys
+import sys, os, re, json
+import numpy as np
 
-def load(filename):
-    sensorStates = []
-    behaviors = []
+# A "'key': value" item of the sensor state dicts written by the collectors,
+# where a value is a list or tuple of numbers, a quoted string or a scalar
+_field_pattern = r"'(\w+)': (\[[^\]]*\]|\([^)]*\)|'[^']*'|[^,\[\]()'{}]+)"
+_field = re.compile(_field_pattern)
+_sensor_state = re.compile(r"\{(?:%s(?:, %s)*)?\}$" % (_field_pattern, _field_pattern))
+
+# The fields every sensor state has and the length of their list or tuple
+# values, None for scalars
+_required_fields = [ ('frontSensors', 5), ('rearSensors', 2), ('groundSensors', 3),
+        ('accelerometer', 3), ('micIntensity', None), ('lassoState', None) ]
+
+def _number(text):
+    text = text.strip().rstrip('L')
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _numbers(text):
+    # Fast path for the usual lists of plain integers
+    try:
+        return map(int, text.split(','))
+    except ValueError:
+        return [ _number(x) for x in text.split(',') if x.strip() ]
+
+def _value(text):
+    if text[0] == '[':
+        return _numbers(text[1:-1])
+    if text[0] == '(':
+        return tuple(_numbers(text[1:-1]))
+    if text[0] == "'":
+        return text[1:-1]
+    text = text.strip()
+    if text in ('True', 'False', 'None'):
+        return { 'True': True, 'False': False, 'None': None }[text]
+    return _number(text)
+
+def parse_sensor_state(line):
+    '''
+    Parse a sensor state dict as printed by the collectors, without eval.
+    Raises ValueError unless the dict has every sensor field, with lists of
+    the right length.
+
+    line: string
+
+    returns: dict
+    '''
+    line = line.strip()
+    if _sensor_state.match(line) is None:
+        raise ValueError('not a sensor state dict')
+
+    sensor_state = dict( (key, _value(value)) for key, value in _field.findall(line) )
+    for key, length in _required_fields:
+        if key not in sensor_state:
+            raise ValueError('missing %s' % key)
+        value = sensor_state[key]
+        if isinstance(value, (list, tuple)) != (length is not None):
+            raise ValueError('malformed %s' % key)
+        if length is not None and len(value) != length:
+            raise ValueError('%s has %d values instead of %d' % (key, len(value), length))
+    return sensor_state
+
+def report(line_no, line, error):
+    '''
+    Default handler of malformed records: report the record and move on
+    '''
+    sys.stderr.write('failed parsing on line %d: %s\n' % (line_no, error))
+
+def iter_load(filename, on_error=report):
+    '''
+    Stream the (sensor state, behavior) pairs of a collector log, whose lines
+    alternate between sensor state dicts and behavior names. A pair whose
+    sensor state cannot be parsed is passed to on_error and skipped. The
+    behavior of a trailing sensor state without one is None.
+
+    filename: string
+    on_error: (int * string * Exception -> unit) function
+
+    returns: (dict * string) generator
+    '''
     with open(filename, 'r') as f:
+        sensor_state = None
         b = False
         i = 0
         for l in f:
             i += 1
-            line = l[:-1]
+            line = l.rstrip('\n')
             if b:
-                behaviors.append(line)
+                if sensor_state is not None:
+                    yield sensor_state, line
             else:
                 try:
-                    sensorStates.append(eval(line))
-                except:
-                    print("failed parsing on line", i)
-                    sys.exit(1)
+                    sensor_state = parse_sensor_state(line)
+                except ValueError as error:
+                    on_error(i, line, error)
+                    sensor_state = None
             b = not b
+
+        if b and sensor_state is not None:
+            yield sensor_state, None
+
+def iter_chunks(filename, chunk_size=10000, on_error=report):
+    '''
+    Stream a collector log in chunks of at most chunk_size sensor states and
+    the behaviors following them
+
+    filename: string
+    chunk_size: int
+    on_error: (int * string * Exception -> unit) function
+
+    returns: ((dict list) * (string list)) generator
+    '''
+    sensorStates = []
+    behaviors = []
+    for sensorState, behavior in iter_load(filename, on_error):
+        sensorStates.append(sensorState)
+        if behavior is not None:
+            behaviors.append(behavior)
+        if len(sensorStates) == chunk_size:
+            yield sensorStates, behaviors
+            sensorStates = []
+            behaviors = []
+
+    if len(sensorStates) > 0:
+        yield sensorStates, behaviors
+
+def load(filename, on_error=report):
+    sensorStates = []
+    behaviors = []
+    for chunkStates, chunkBehaviors in iter_chunks(filename, on_error=on_error):
+        sensorStates += chunkStates
+        behaviors += chunkBehaviors
     return sensorStates, behaviors
+
+
+# Columns of the binary log format: name, dtype, values per record. The
+# lasso column is 1 when the lasso is down, the behavior column indexes the
+# behavior table of the log (-1 for a trailing state without behavior)
+COLUMNS = [
+    ('frontSensors', 'int16', 5),
+    ('rearSensors', 'int16', 2),
+    ('groundSensors', 'int16', 3),
+    ('accelerometer', 'int16', 3),
+    ('micIntensity', 'int16', 1),
+    ('lassoState', 'uint8', 1),
+    ('behavior', 'int8', 1),
+]
+COLUMNS_VERSION = 1
+
+def _column_filename(dirname, name):
+    return os.path.join(dirname, name + '.bin')
+
+def convert(filename, dirname, chunk_size=100000, on_error=report):
+    '''
+    Convert a text collector log into the binary columnar format: a directory
+    holding one fixed width binary file per column and a meta.json describing
+    the columns, the number of records and the behavior table
+
+    filename: string
+    dirname: string
+    chunk_size: int
+    on_error: (int * string * Exception -> unit) function
+
+    returns: int, the number of records written
+    '''
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    files = dict( (name, open(_column_filename(dirname, name), 'wb')) for name, _, _ in COLUMNS )
+    behaviors = []
+    behavior_ids = {}
+    length = 0
+    try:
+        chunk = []
+        for pair in iter_load(filename, on_error):
+            chunk.append(pair)
+            if len(chunk) == chunk_size:
+                _write_chunk(files, chunk, behaviors, behavior_ids)
+                length += len(chunk)
+                chunk = []
+        _write_chunk(files, chunk, behaviors, behavior_ids)
+        length += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = {
+        'version': COLUMNS_VERSION,
+        'length': length,
+        'columns': [ list(column) for column in COLUMNS ],
+        'behaviors': behaviors,
+    }
+    with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return length
+
+def _write_chunk(files, chunk, behaviors, behavior_ids):
+    if len(chunk) == 0:
+        return
+
+    def behavior_id(behavior):
+        if behavior is None:
+            return -1
+        if behavior not in behavior_ids:
+            behavior_ids[behavior] = len(behaviors)
+            behaviors.append(behavior)
+        return behavior_ids[behavior]
+
+    values = {
+        'frontSensors': [ s['frontSensors'] for s, _ in chunk ],
+        'rearSensors': [ s['rearSensors'] for s, _ in chunk ],
+        'groundSensors': [ s['groundSensors'] for s, _ in chunk ],
+        'accelerometer': [ s['accelerometer'] for s, _ in chunk ],
+        'micIntensity': [ s['micIntensity'] for s, _ in chunk ],
+        'lassoState': [ s['lassoState'] == 'down' for s, _ in chunk ],
+        'behavior': [ behavior_id(b) for _, b in chunk ],
+    }
+    for name, dtype, _ in COLUMNS:
+        np.asarray(values[name], dtype=dtype).tofile(files[name])
+
+class ColumnarLog():
+    '''
+    A binary columnar log (see convert) opened with np.memmap. Columns are
+    read-only arrays of N records (N x width for multi-valued sensors) that
+    can be sliced without parsing or copying.
+    '''
+
+    def __init__(self, dirname):
+        with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != COLUMNS_VERSION:
+            raise Exception('Unsupported log version %d' % meta['version'])
+
+        self.length = meta['length']
+        self.behavior_names = [ str(b) for b in meta['behaviors'] ]
+        self.columns = {}
+        for name, dtype, width in meta['columns']:
+            name = str(name)
+            shape = (self.length, width) if width > 1 else (self.length,)
+            if self.length == 0:
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(_column_filename(dirname, name),
+                        dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def slice(self, start=None, stop=None):
+        '''
+        Get views of all columns for the records in the given range
+
+        returns: dict of string -> array
+        '''
+        return dict( (name, column[start:stop]) for name, column in self.columns.iteritems() )
+
+    def behaviors(self, start=None, stop=None):
+        '''
+        Get the names of the behaviors following the records in the given
+        range, leaving out the missing behavior of a trailing record
+
+        returns: string list
+        '''
+        ids = self.columns['behavior'][start:stop]
+        return [ self.behavior_names[i] for i in ids if i >= 0 ]
+
+    def sensor_state(self, i):
+        '''
+        Get record i as a sensor state dict, as printed by the collectors
+
+        returns: dict
+        '''
+        return {
+            'frontSensors': self.columns['frontSensors'][i].tolist(),
+            'rearSensors': self.columns['rearSensors'][i].tolist(),
+            'groundSensors': tuple(self.columns['groundSensors'][i].tolist()),
+            'accelerometer': self.columns['accelerometer'][i].tolist(),
+            'micIntensity': int(self.columns['micIntensity'][i]),
+            'lassoState': 'down' if self.columns['lassoState'][i] else 'up',
+        }
+
+    def sensor_states(self, start=None, stop=None):
+        '''
+        Iterate the records in the given range as sensor state dicts
+
+        returns: dict generator
+        '''
+        for i in xrange(*slice(start, stop).indices(self.length)):
+            yield self.sensor_state(i)
+
+
+def open_log(filename):
+    '''
+    Open a collector log, either a text log (parsed with load) or a columnar
+    log directory (memory-mapped with ColumnarLog). Either way the sensor
+    states can be passed to normalization.normalize_many.
+
+    filename: string
+
+    returns: ((dict list) or ColumnarLog) * (string list)
+    '''
+    if os.path.isdir(filename):
+        log = ColumnarLog(filename)
+        return log, log.behaviors()
+    return load(filename)
+
+
+# Application entry point
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python dataloader.py <log file> <columnar log directory>')
+        sys.exit(1)
+    print(convert(sys.argv[1], sys.argv[2]))
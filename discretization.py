@@ -1,6 +1,7 @@
-import random, math
+import random, math, datetime, os, hashlib, tempfile
 from minisom import MiniSom
 from scipy.cluster.vq import kmeans2
+from scipy.spatial import cKDTree
 import numpy as np
 from sys import maxint
 from PIL import Image, ImageDraw
@@ -9,6 +10,9 @@ import matplotlib.pyplot as plt
 
 class Discretizer():
 
+    # DiscretizerCache used by cached_train, if any
+    cache = None
+
     def train(self, data):
         '''
         Train the discretizer on the raw data set
@@ -29,6 +33,47 @@ class Discretizer():
         '''
         raise Exception('Not implemented')
 
+    def discretize_many(self, data_points):
+        '''
+        Discretize a batch of sensor states in one pass. Row i of the result
+        is the discretization of row i of the given data points.
+
+        data_points: (float list) list or N x D array
+
+        returns: N x D' array
+        '''
+        return np.array([ self.discretize(data_point) for data_point in data_points ])
+
+    def hyperparameters(self):
+        '''
+        The constructor arguments that determine the trained model. Together
+        with the training data these key the discretizer cache
+
+        returns: dict
+        '''
+        return {}
+
+    def cached_train(self, data, fit):
+        '''
+        Get the model trained on the given data. If a discretizer cache is set
+        and holds a model for the data and hyperparameters it is loaded,
+        otherwise the model is computed by fit and stored in the cache
+
+        data: (float list) list or N x D array
+        fit: (unit -> array) function
+
+        returns: array
+        '''
+        if self.cache is None:
+            return fit()
+
+        key = self.cache.key(self, data)
+        model = self.cache.get(key)
+        if model is None:
+            model = fit()
+            self.cache.put(key, model)
+        return model
+
     def visualize(self, filename, subset=None):
         '''
         Visualize the state of the discretizer.
@@ -69,14 +114,159 @@ class Discretizer():
         return self.norm_data_vector(diff_vector)
 
 
+class DiscretizerCache():
+    '''
+    Content addressed on-disk cache of trained discretizer models. A model is
+    keyed by a hash of the training data, the discretizer class and its
+    hyperparameters, and stored as a .npy file. The least recently used models
+    are evicted once the cache grows beyond max_bytes.
+    '''
+
+    def __init__(self, directory='discretizer_cache', max_bytes=256*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, discretizer, data):
+        '''
+        Compute the cache key of training the given discretizer on the data
+
+        discretizer: Discretizer
+        data: (float list) list or N x D array
+
+        returns: string
+        '''
+        data = np.ascontiguousarray(data, dtype=float)
+        digest = hashlib.sha1()
+        digest.update(discretizer.__class__.__name__)
+        digest.update(repr(sorted(discretizer.hyperparameters().items())))
+        digest.update(repr(data.shape))
+        digest.update(data.tostring())
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        '''
+        Load the model stored under the given key
+
+        key: string
+
+        returns: array, or None if the key is not cached
+        '''
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        # Mark the model as recently used
+        os.utime(filename, None)
+        return np.load(filename)
+
+    def put(self, key, model):
+        '''
+        Store the model under the given key and evict old models. A model
+        larger than max_bytes is not stored, as it would evict every other
+        model and then itself.
+
+        key: string
+        model: array
+
+        returns: None
+        '''
+        # Write to a temporary file first so a crash never leaves a partial model
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(model))
+        if os.path.getsize(temporary) > self.max_bytes:
+            os.remove(temporary)
+            return
+        os.rename(temporary, self.filename(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used models until the cache fits in
+        max_bytes, never the model stored under keep
+
+        keep: string, or None
+
+        returns: None
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy') and name != '%s.npy' % keep:
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append( (stat.st_mtime, stat.st_size, name) )
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(self.filename(keep)):
+            total += os.path.getsize(self.filename(keep))
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def nearest_prototypes(data_points, prototypes, block_size=4096):
+    '''
+    Find the index of the nearest prototype for every data point, using the
+    expansion |x - c|^2 = |x|^2 - 2 x.c + |c|^2 so only an N x k distance
+    matrix is materialized (in blocks of block_size rows)
+
+    data_points: N x D array
+    prototypes: k x D array
+
+    returns: int array of length N
+    '''
+    data_points = np.atleast_2d(np.asarray(data_points, dtype=float))
+    prototypes = np.asarray(prototypes, dtype=float)
+    prototype_norms = np.sum(prototypes**2, axis=1)
+
+    indices = np.empty(len(data_points), dtype=int)
+    for start in range(0, len(data_points), block_size):
+        block = data_points[start:start+block_size]
+        distances = prototype_norms - 2 * np.dot(block, prototypes.T)
+        indices[start:start+block_size] = np.argmin(distances, axis=1)
+    return indices
+
+
 class KMeansDiscretizer(Discretizer):
-    def __init__(self, k):
+    def __init__(self, k, use_index=False, cache=None):
+        '''
+        k: int, number of centroids
+        use_index: bool, look up the nearest centroid through a KD-tree built
+            after training instead of scanning every centroid. Pays off for
+            large k (see discretizer_benchmark.py)
+        cache: DiscretizerCache, reuse centroids trained on the same data
+        '''
         self.k = k
+        self.use_index = use_index
+        self.index = None
+        self.cache = cache
+
+    def hyperparameters(self):
+        return { 'k': self.k }
 
     def train(self, data):
-        self.centroids, _ = kmeans2(data, self.k)
+        self.centroids = self.cached_train(data, lambda: kmeans2(data, self.k)[0])
+        self.build_index()
+
+    def build_index(self):
+        '''
+        (Re)build the nearest centroid index, if enabled
+
+        returns: None
+        '''
+        self.index = cKDTree(self.centroids) if self.use_index else None
 
     def discretize(self, data_point):
+        if self.index is not None:
+            _, i = self.index.query(data_point)
+            return self.centroids[i]
+
         mincen = []
         mindist = maxint
         for c in self.centroids:
@@ -86,6 +276,11 @@ class KMeansDiscretizer(Discretizer):
                 mindist = dist
         return mincen
 
+    def discretize_many(self, data_points):
+        # Batches use the blocked scan, which beats the KD-tree below ~1000
+        # prototypes
+        return self.centroids[nearest_prototypes(data_points, self.centroids)]
+
     #def visualize(self, filename, subset=None):
         ## Check if only a subset is to be visualized
         #centroids = self.centroids
@@ -126,20 +321,131 @@ class KMeansDiscretizer(Discretizer):
 
 class SOMDiscretizer(Discretizer):
 
-    def __init__(self, width=4, height=4, sigma=0.3, learning_rate=0.5):
+    def __init__(self, width=4, height=4, sigma=0.3, learning_rate=0.5, use_index=False,
+            training='random', epochs=200, tolerance=1e-5, random_seed=None, cache=None):
+        '''
+        use_index: bool, look up the winning neuron through a KD-tree over the
+            SOM weights built after training instead of computing the distance
+            to every neuron. Pays off for large maps (see
+            discretizer_benchmark.py)
+        training: string, 'random' for MiniSom's one sample per iteration
+            training, 'batch' for the vectorized batch SOM (see train_batch)
+        epochs: int, maximum number of batch training epochs
+        tolerance: float, batch training stops once the quantization error
+            changes less than this between two epochs
+        random_seed: int, seed for the batch training initialization
+        cache: DiscretizerCache, reuse SOM weights trained on the same data
+        '''
         self.width = width
         self.height = height
         self.sigma = sigma
         self.learning_rate = learning_rate
+        self.use_index = use_index
+        self.index = None
+        self.training = training
+        self.epochs = epochs
+        self.tolerance = tolerance
+        self.random_seed = random_seed
+        self.cache = cache
+
+    def hyperparameters(self):
+        parameters = {
+            'width': self.width,
+            'height': self.height,
+            'sigma': self.sigma,
+            'training': self.training,
+        }
+        if self.training == 'batch':
+            parameters.update(epochs=self.epochs, tolerance=self.tolerance, random_seed=self.random_seed)
+        else:
+            parameters.update(learning_rate=self.learning_rate)
+        return parameters
 
     def train(self, data):
         self.som = MiniSom(self.width, self.height, len(data[0]), sigma=self.sigma, learning_rate=self.learning_rate)
-        self.som.train_random(data, 1000000)
+
+        def fit():
+            if self.training == 'batch':
+                return self.train_batch(np.asarray(data, dtype=float))
+            self.som.train_random(data, 1000000)
+            return self.som.weights
+
+        self.som.weights = self.cached_train(data, fit)
+        self.build_index()
+
+    def train_batch(self, data):
+        '''
+        Batch SOM training. Every epoch assigns all samples to their winning
+        neurons at once and moves each neuron to the neighborhood weighted mean
+        of the samples, with the neighborhood radius decaying like MiniSom's.
+        Stops early once the quantization error converges. The error and time
+        of every epoch are printed and kept in self.training_log.
+
+        data: N x D array
+
+        returns: width x height x D array
+        '''
+        neurons = self.width * self.height
+        rng = np.random.RandomState(self.random_seed)
+        samples = rng.choice(len(data), neurons, replace=len(data) < neurons)
+        weights = data[samples].copy()
+
+        grid = np.array([ (i, j) for i in range(self.width) for j in range(self.height) ], dtype=float)
+        grid_distances = np.sum((grid[:, np.newaxis, :] - grid[np.newaxis, :, :])**2, axis=2)
+
+        self.training_log = []
+        previous_error = None
+        for epoch in range(self.epochs):
+            t1 = datetime.datetime.now()
+
+            winners = nearest_prototypes(data, weights)
+            error = np.mean(np.linalg.norm(data - weights[winners], axis=1))
+
+            # Per neuron sample counts and sums, spread over the neighborhood
+            sigma = self.sigma / (1 + epoch / (self.epochs / 2.0))
+            neighborhood = np.exp(-grid_distances / (2 * sigma * sigma))
+            counts = np.bincount(winners, minlength=neurons)
+            sums = np.column_stack([ np.bincount(winners, data[:, d], minlength=neurons)
+                for d in range(data.shape[1]) ])
+            numerator = np.dot(neighborhood, sums)
+            denominator = np.dot(neighborhood, counts)
+
+            updated = denominator > 0
+            weights[updated] = numerator[updated] / denominator[updated][:, np.newaxis]
+
+            t2 = datetime.datetime.now()
+            print('%d: %f (%s)' % (epoch, error, t2 - t1))
+            self.training_log.append( (epoch, error, (t2 - t1).total_seconds()) )
+
+            if previous_error is not None and abs(previous_error - error) < self.tolerance:
+                break
+            previous_error = error
+
+        return weights.reshape(self.width, self.height, -1)
+
+    def build_index(self):
+        '''
+        (Re)build the winning neuron index, if enabled
+
+        returns: None
+        '''
+        # Row i of the prototypes is neuron (i / height, i % height)
+        self.prototypes = self.som.weights.reshape(self.width * self.height, -1)
+        self.index = cKDTree(self.prototypes) if self.use_index else None
 
     def discretize(self, data_point):
+        if self.index is not None:
+            _, i = self.index.query(data_point)
+            return self.prototypes[i]
+
         x, y = self.som.winner(data_point)
         return self.som.weights[x,y]
 
+    def discretize_many(self, data_points):
+        # Batches use the blocked scan, which beats the KD-tree below ~1000
+        # prototypes
+        return self.prototypes[nearest_prototypes(data_points, self.prototypes)]
+
     def visualize(self, filename, subset=None):
         box_side = 150
         border = 30
@@ -242,6 +548,9 @@ class NoDiscretizer(Discretizer):
     def discretize(self, data_point):
         return data_point
 
+    def discretize_many(self, data_points):
+        return np.array(data_points, dtype=float)
+
 
 class RoundingDiscretizer(Discretizer):
 
@@ -251,6 +560,11 @@ class RoundingDiscretizer(Discretizer):
     def discretize(self, data_point):
         return map(round, data_point)
 
+    def discretize_many(self, data_points):
+        # Python 2 round() rounds halves away from zero, np.round to even
+        data_points = np.asarray(data_points, dtype=float)
+        return np.sign(data_points) * np.floor(np.abs(data_points) + 0.5)
+
 
 class SimplifyingDiscretizer(Discretizer):
 
@@ -268,6 +582,16 @@ class SimplifyingDiscretizer(Discretizer):
 
         return map(float, [close_to_object, facing_object, lasso])
 
+    def discretize_many(self, data_points):
+        data_points = np.asarray(data_points, dtype=float)
+        front_sensors = data_points[:, :5]
+        lasso = data_points[:, 8]
+
+        close_to_object = np.any(front_sensors > 0, axis=1)
+        facing_object = close_to_object & (front_sensors.max(axis=1) == front_sensors[:, 2])
+
+        return np.column_stack([close_to_object, facing_object, lasso]).astype(float)
+
 
 # Application entry point
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+import time
+import numpy as np
+import discretization
+
+def measure(f, repeat=3):
+    '''
+    Best wall clock time of calling f repeat times
+    '''
+    best = None
+    for i in range(repeat):
+        t1 = time.time()
+        f()
+        t2 = time.time()
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    return best
+
+def kmeans_discretizer(centroids, use_index):
+    discretizer = discretization.KMeansDiscretizer(len(centroids), use_index=use_index)
+    discretizer.centroids = centroids
+    discretizer.build_index()
+    return discretizer
+
+def som_discretizer(side, dimensions, use_index):
+    discretizer = discretization.SOMDiscretizer(side, side, use_index=use_index)
+    discretizer.som = discretization.MiniSom(side, side, dimensions)
+    discretizer.build_index()
+    return discretizer
+
+def single_lookups(discretizer, points):
+    return lambda: [ discretizer.discretize(p) for p in points ]
+
+def batch_lookup(discretizer, points):
+    return lambda: discretizer.discretize_many(points)
+
+def batch_index_lookup(discretizer, points):
+    return lambda: discretizer.index.query(points)
+
+if __name__ == '__main__':
+    dimensions = 9
+    single_queries = 2000
+    batch_queries = 20000
+    rng = np.random.RandomState(0)
+
+    single_points = rng.rand(single_queries, dimensions)
+    batch_points = rng.rand(batch_queries, dimensions)
+
+    print('Nearest prototype lookup, %d dimensions' % dimensions)
+    print('%6s %14s %14s %14s %14s' % ('k', 'scan (us)', 'kd-tree (us)', 'batch (ms)', 'kd batch (ms)'))
+
+    crossover = None
+    for k in [4, 8, 16, 25, 36, 64, 100, 200, 400, 1000]:
+        centroids = rng.rand(k, dimensions)
+        brute = kmeans_discretizer(centroids, False)
+        indexed = kmeans_discretizer(centroids, True)
+
+        brute_single = measure(single_lookups(brute, single_points)) / single_queries
+        indexed_single = measure(single_lookups(indexed, single_points)) / single_queries
+        brute_batch = measure(batch_lookup(brute, batch_points))
+        indexed_batch = measure(batch_index_lookup(indexed, batch_points))
+
+        if crossover is None and indexed_single < brute_single:
+            crossover = k
+
+        print('%6d %14.1f %14.1f %14.2f %14.2f' % (k,
+            brute_single * 1e6, indexed_single * 1e6,
+            brute_batch * 1e3, indexed_batch * 1e3))
+
+    if crossover is None:
+        print('The KD-tree never beat the linear scan for single lookups')
+    else:
+        print('The KD-tree beats the linear scan for single lookups from k = %d' % crossover)
+
+    print('')
+    print('SOM winner lookup, %d dimensions' % dimensions)
+    print('%6s %14s %14s' % ('map', 'winner (us)', 'kd-tree (us)'))
+
+    crossover = None
+    for side in [2, 4, 6, 8, 10, 14, 20, 30]:
+        brute = som_discretizer(side, dimensions, False)
+        indexed = som_discretizer(side, dimensions, True)
+        indexed.som.weights = brute.som.weights
+        indexed.build_index()
+
+        brute_single = measure(single_lookups(brute, single_points)) / single_queries
+        indexed_single = measure(single_lookups(indexed, single_points)) / single_queries
+
+        if crossover is None and indexed_single < brute_single:
+            crossover = side
+
+        print('%6s %14.1f %14.1f' % ('%dx%d' % (side, side),
+            brute_single * 1e6, indexed_single * 1e6))
+
+    if crossover is None:
+        print('The KD-tree never beat MiniSom.winner')
+    else:
+        print('The KD-tree beats MiniSom.winner from a %dx%d map' % (crossover, crossover))
@@ -19,8 +19,8 @@ if __name__ == '__main__':
     output_dir = 'discretizer_visualizations'
     reset_dir(output_dir)
 
-    sensor_states, behaviors = dataloader.load('test.out')
-    norm_sensor_states = map(normalization.normalize, sensor_states)
+    sensor_states, behaviors = dataloader.open_log('test.out')
+    norm_sensor_states = normalization.normalize_many(sensor_states)
 
     for data_length in [300, 1000, 10000]:
         data = norm_sensor_states[:data_length]
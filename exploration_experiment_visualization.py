@@ -2,7 +2,7 @@ import dataloader
 from textwrap import wrap
 import sys
 from discretization import SimplifyingDiscretizer
-from normalization import normalize
+from normalization import normalize_many
 from graph import MarkovChainGraph
 import matplotlib.pyplot as plt
 stateTranslate = {
@@ -17,14 +17,13 @@ stateTranslate = {
 if __name__ == '__main__':
     plt.rcParams.update({'figure.autolayout': True})
     filename = sys.argv[1]
-    sensorStates, behaviors = dataloader.load(filename)
+    sensorStates, behaviors = dataloader.open_log(filename)
     discretizer = SimplifyingDiscretizer()
     graph = MarkovChainGraph()
     result = {}
     ss = []
-    for sensorState in sensorStates:
-        sensorState = normalize(sensorState)
-        s = discretizer.discretize(sensorState)
+    discSensorStates = discretizer.discretize_many(normalize_many(sensorStates)).tolist()
+    for s in discSensorStates:
         s = graph.state_to_key(s)
         ss.append(stateTranslate[s])
         if stateTranslate[s] in result:
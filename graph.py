@@ -1,11 +1,149 @@
-import random, pickle, datetime
+import os, glob, random, json, struct, datetime, threading, Queue
+from collections import deque
+import numpy as np
 
 from pybrain.structure import FeedForwardNetwork, LinearLayer, SigmoidLayer, FullConnection
 from pybrain.datasets import SupervisedDataSet
 from pybrain.supervised.trainers import BackpropTrainer
 
+class StateTable():
+    '''
+    Interning table mapping state keys to dense integer ids. The key and the
+    state of an id are stored once, when the state is first seen, so graphs
+    can hand out ids and never format or parse keys while searching.
+    '''
+
+    def __init__(self):
+        self.ids = {}     # Key -> Id
+        self.keys = []    # Id -> Key
+        self.states = []  # Id -> State
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, key):
+        '''
+        Get the id of the given key
+
+        key: string
+
+        returns: int, or None if the key has not been interned
+        '''
+        return self.ids.get(key)
+
+    def intern(self, key, state):
+        '''
+        Get the id of the given key, assigning the next free id to it (and
+        storing the given state for it) if it has not been seen before
+
+        key: string
+        state: float list
+
+        returns: int
+        '''
+        state_id = self.ids.get(key)
+        if state_id is None:
+            state_id = len(self.keys)
+            self.ids[key] = state_id
+            self.keys.append(key)
+            self.states.append(state)
+        return state_id
+
+    def restore(self, keys):
+        '''
+        Replace the table with the given keys, ids being their positions. The
+        states are parsed from the keys when first asked for (see Graph.state).
+
+        keys: string list
+
+        returns: None
+        '''
+        self.keys = keys
+        self.ids = dict(zip(keys, xrange(len(keys))))
+        self.states = [None] * len(keys)
+
+
+# Graph snapshot files start with the magic bytes, the format version and the
+# length of a JSON header describing the graph and the arrays following it.
+# Arrays are stored raw and 8 byte aligned, so they can be memory-mapped.
+SNAPSHOT_MAGIC = 'ERLGRAPH'
+SNAPSHOT_VERSION = 1
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def write_snapshot(filename, header, arrays):
+    '''
+    Write a graph snapshot file
+
+    filename: string
+    header: dict, JSON serializable
+    arrays: dict of string -> array
+
+    returns: None
+    '''
+    arrays = [ (name, np.ascontiguousarray(array)) for name, array in sorted(arrays.iteritems()) ]
+
+    # The offsets depend on the header length, which depends on the offsets
+    offset = 0
+    while True:
+        position = offset
+        layout = []
+        for name, array in arrays:
+            position = _align(position)
+            layout.append( [name, array.dtype.str, list(array.shape), position] )
+            position += array.nbytes
+        header['arrays'] = layout
+        text = json.dumps(header)
+        start = _align(len(SNAPSHOT_MAGIC) + 8 + len(text))
+        if start == offset:
+            break
+        offset = start
+
+    with open(filename, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<II', SNAPSHOT_VERSION, len(text)))
+        f.write(text)
+        for (name, array), (_, _, _, position) in zip(arrays, layout):
+            f.write('\0' * (position - f.tell()))
+            f.write(array.tostring())
+
+def read_snapshot(filename):
+    '''
+    Read a graph snapshot file, memory-mapping its arrays
+
+    filename: string
+
+    returns: dict * (dict of string -> array), the header and the arrays
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception('Not a graph snapshot: %s' % filename)
+        version, length = struct.unpack('<II', f.read(8))
+        if version != SNAPSHOT_VERSION:
+            raise Exception('Unsupported graph snapshot version %d' % version)
+        header = json.loads(f.read(length))
+
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, dtype, shape, position in header['arrays']:
+        dtype = np.dtype(str(dtype))
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[str(name)] = data[position:position + nbytes].view(dtype).reshape(shape)
+    return header, arrays
+
+
 class Graph():
 
+    # Whether the graph has a finite transition table, whose states all have
+    # ids (see transition_arrays). Other graphs are searched over states.
+    finite = False
+
+    def __init__(self):
+        self.table = StateTable()
+        self.version = 0  # Incremented whenever transitions change
+
     def construct(self, sensor_states, behaviors):
         '''
         Construct the graph (the neighborhood function) based on the given
@@ -30,49 +168,144 @@ class Graph():
         '''
         raise Exception('Not implemented')
 
+    def state_id(self, sensor_state):
+        '''
+        Get the integer id of the given sensor state, interning the state if
+        it has not been seen before
+
+        sensor_state: float list
+
+        returns: int
+        '''
+        key = self.state_to_key(sensor_state)
+        return self.table.intern(key, self.key_to_state(key))
+
+    def state(self, state_id):
+        '''
+        Get the sensor state with the given id
+
+        state_id: int
+
+        returns: float list
+        '''
+        state = self.table.states[state_id]
+        if state is None:
+            # Not parsed since the graph was loaded
+            state = self.key_to_state(self.table.keys[state_id])
+            self.table.states[state_id] = state
+        return state
+
+    def key(self, state_id):
+        '''
+        Get the key of the sensor state with the given id
+
+        state_id: int
+
+        returns: string
+        '''
+        return self.table.keys[state_id]
+
+    def neighbor_ids(self, state_id):
+        '''
+        Same as neighbors, but from and to state ids. Neighbors are interned,
+        so on graphs without a finite transition table this grows the state
+        table with every state asked for.
+
+        state_id: int
+
+        returns: (string * int * float) list
+        '''
+        return [ (b, self.state_id(s), w) for b, s, w in self.neighbors(self.state(state_id)) ]
+
+    def transition_arrays(self):
+        '''
+        Get the transitions of the graph as arrays in compressed sparse row
+        layout, for vectorized searches: the edges leaving state id i are the
+        indices indptr[i] to indptr[i+1] of the edge behavior id, next state
+        id and weight arrays. Graphs without a finite transition table return
+        None.
+
+        returns: (int array, int array, int array, float array)
+        '''
+        return None
+
     def save(self, filename):
-        with open(filename, 'w') as f:
-            pickle.dump(self.__dict__, f)
+        '''
+        Save the graph to a binary snapshot file (see write_snapshot)
+
+        filename: string
+
+        returns: None
+        '''
+        attributes, arrays = self.snapshot()
+        arrays['keys'] = np.frombuffer('\n'.join(self.table.keys), dtype=np.uint8)
+        header = {
+            'type': self.__class__.__name__,
+            'states': len(self.table),
+            'attributes': attributes,
+        }
+        write_snapshot(filename, header, arrays)
 
     def load(self, filename):
-        with open(filename, 'r') as f:
-            self.__dict = pickle.load(f)
+        '''
+        Replace the graph with the one saved to the given file. The arrays of
+        the file are memory-mapped rather than read.
 
-    def state_to_key(self, sensor_state):
-        return ', '.join(map(str, map(abs, sensor_state))) if not isinstance(sensor_state, str) else sensor_state
+        filename: string
 
-    def key_to_state(self, key):
-        return map(float, key.split(', ')) if ',' in key else key
+        returns: None
+        '''
+        header, arrays = read_snapshot(filename)
+        if header['type'] != self.__class__.__name__:
+            raise Exception('Cannot load a %s snapshot into a %s' % (header['type'], self.__class__.__name__))
 
-    def visualize(self, filename, initial_sensor_state):
-        # Construct the full graph
-        next_node_id = 0
-        visited = {}
-        edges = []
+        keys = arrays.pop('keys').tostring().split('\n') if header['states'] > 0 else []
+        self.table.restore(keys)
+        self.restore(header['attributes'], arrays)
+        self.version += 1
 
-        def traverse(sensor_state, next_node_id, visited, edges):
-            '''
-            Traverses the graph, constructing the nodes and edges
-            '''
-            key = self.state_to_key(sensor_state)
+    def snapshot(self):
+        '''
+        Get what is saved of the graph besides its state table
 
-            if key in visited:
-                return next_node_id
+        returns: dict * (dict of string -> array), the JSON serializable
+            attributes and the arrays
+        '''
+        return {}, {}
 
-            visited[key] = next_node_id
-            next_node_id += 1
+    def restore(self, attributes, arrays):
+        '''
+        Restore what snapshot returned
 
-            for behavior, neighbor_state, weight in self.neighbors(sensor_state):
-                other_key = self.state_to_key(neighbor_state)
+        attributes: dict
+        arrays: dict of string -> array
 
-                edges.append( (key, other_key, behavior, weight) )
-                next_node_id = traverse(neighbor_state, next_node_id, visited, edges)
+        returns: None
+        '''
+        pass
 
-            return next_node_id
+    def state_to_key(self, sensor_state):
+        return ', '.join(map(str, map(abs, sensor_state))) if not isinstance(sensor_state, str) else sensor_state
 
-        traverse(initial_sensor_state, 0, visited, edges) 
+    def key_to_state(self, key):
+        return map(float, key.split(', ')) if ',' in key else key
 
-        # Output the graph in DOT format
+    def visualize(self, filename, initial_sensor_state, max_depth=None, max_nodes=None, aggregate=False):
+        '''
+        Output the graph reachable from the given sensor state in DOT format.
+        The graph is traversed breadth first and written while traversing, so
+        memory only grows with the number of states, not edges.
+
+        filename: string
+        initial_sensor_state: float list
+        max_depth: int, only include the states reachable within this many
+            behaviors, or None for all of them
+        max_nodes: int, stop including states after this many, or None
+        aggregate: bool, draw the edges from one state to another as a single
+            edge labelled with all of their behaviors
+
+        returns: int, the number of states written
+        '''
         with open(filename, 'w') as f:
             def wrln(s, indent=1):
                 f.write("\t"*indent + s + "\n")
@@ -80,72 +313,567 @@ class Graph():
             # Start the graph
             wrln('digraph G {', 0)
 
-            # Output the node definitions
-            for key in sorted(visited, key=visited.get):
-                node_label = key
-                node_id = visited[key]
-                wrln('%d [label = "%s"];' % (node_id, node_label))
+            nodes = {} # State id -> Node id
+
+            def add_node(state_id):
+                nodes[state_id] = len(nodes)
+                wrln('%d [label = "%s"];' % (nodes[state_id], self.key(state_id)))
 
-            wrln('')
+            initial_id = self.state_id(initial_sensor_state)
+            add_node(initial_id)
+            queue = deque([ (initial_id, 0) ])
 
-            # Output the edges
-            for key_a, key_b, behavior, weight in edges:
-                node_a_id = visited[key_a]
-                node_b_id = visited[key_b]
-                wrln('%d -> %d [ label = "%s, %d" ];' % (node_a_id, node_b_id, behavior, weight))
+            while len(queue) > 0:
+                state_id, depth = queue.popleft()
+                if max_depth is not None and depth >= max_depth:
+                    continue
+
+                edges = [] # (Node id, label)
+                for behavior, neighbor_id, weight in self.neighbor_ids(state_id):
+                    if neighbor_id not in nodes:
+                        if max_nodes is not None and len(nodes) >= max_nodes:
+                            continue
+                        add_node(neighbor_id)
+                        queue.append( (neighbor_id, depth + 1) )
+                    edges.append( (nodes[neighbor_id], '%s, %d' % (behavior, weight)) )
+
+                if aggregate:
+                    labels = {} # Node id -> labels
+                    for node_id, label in edges:
+                        labels.setdefault(node_id, []).append(label)
+                    edges = [ (node_id, '\\n'.join(labels[node_id])) for node_id in sorted(labels) ]
+
+                # Output the edges
+                for node_id, label in edges:
+                    wrln('%d -> %d [ label = "%s" ];' % (nodes[state_id], node_id, label))
 
             # End the graph
             wrln('}', 0)
 
+        return len(nodes)
+
 
 class MarkovChainGraph(Graph):
 
+    finite = True
+
     def __init__(self):
-        self.states = {}
+        Graph.__init__(self)
+        self.behaviors = []     # Behavior id -> Behavior
+        self.behavior_ids = {}  # Behavior -> Behavior id
+        self.transitions = {}   # State id -> Behavior id -> State id -> Count
+        self.totals = {}        # State id -> Behavior id -> Count
+        self.edges = {}         # State id -> Cached neighbor_ids result
+        self.arrays = None      # Cached transition_arrays result
+        self.state_versions = {}  # State id -> Graph version of its last new transition
+        self.stored = None      # Transition arrays of a loaded snapshot
+        self.log = None         # TransitionLog of the graph's changes
+
+    def behavior_id(self, behavior):
+        '''
+        Get the integer id of the given behavior, assigning one if needed
+
+        behavior: string
+
+        returns: int
+        '''
+        behavior_id = self.behavior_ids.get(behavior)
+        if behavior_id is None:
+            behavior_id = len(self.behaviors)
+            self.behavior_ids[behavior] = behavior_id
+            self.behaviors.append(behavior)
+        return behavior_id
 
     def construct(self, sensor_states, behaviors):
-        previous_state = sensor_states[0]
+        previous_id = self.state_id(sensor_states[0])
         for i in range(1, len(sensor_states)):
-            current_state = sensor_states[i]
-            behavior = behaviors[i-1]
+            current_id = self.state_id(sensor_states[i])
+            self.add_transition(previous_id, behaviors[i-1], current_id)
+            previous_id = current_id
 
-            key = self.state_to_key(previous_state)
-            if not key in self.states:
-                self.states[key] = {}
-            neighbors = self.states[key]
+    def add_transition(self, state_id, behavior, next_state_id, count=1):
+        '''
+        Count transition(s) from one state id to another under a behavior
+
+        state_id: int
+        behavior: string
+        next_state_id: int
+        count: int
+
+        returns: None
+        '''
+        behavior_id = self.behavior_id(behavior)
+        self.materialize(state_id)
+        neighbors = self.transitions.setdefault(state_id, {})
+        chain = neighbors.setdefault(behavior_id, {})
+        chain[next_state_id] = chain.get(next_state_id, 0) + count
 
-            if not behavior in neighbors:
-                neighbors[behavior] = {}
-            chain = neighbors[behavior]
+        totals = self.totals.setdefault(state_id, {})
+        totals[behavior_id] = totals.get(behavior_id, 0) + count
 
-            key = self.state_to_key(current_state)
-            if not key in chain:
-                chain[key] = 0
-            chain[key] += 1
+        # Only the edge weights leaving this state changed
+        self.edges.pop(state_id, None)
+        self.arrays = None
+        self.version += 1
+        self.state_versions[state_id] = self.version
 
-            previous_state = current_state
+        if self.log is not None:
+            self.log.transition(state_id, behavior_id, next_state_id, count)
 
     def neighbors(self, sensor_state):
+        state_id = self.table.lookup(self.state_to_key(sensor_state))
+        if state_id is None:
+            return []
+        return [ (b, self.state(s), w) for b, s, w in self.neighbor_ids(state_id) ]
+
+    def neighbor_ids(self, state_id):
+        # The returned list is cached until the state gets a new transition,
+        # so callers must not modify it
+        edges = self.edges.get(state_id)
+        if edges is not None:
+            return edges
+
         edges = []
 
-        key = self.state_to_key(sensor_state)
-        if not key in self.states:
-            return []
-        neighbors = self.states[key]
+        self.materialize(state_id)
+        if not state_id in self.transitions:
+            return edges
+        neighbors = self.transitions[state_id]
+        totals = self.totals[state_id]
 
-        for behavior in neighbors:
-            total = sum(count for state, count in neighbors[behavior].iteritems())
-            for neighbor_state_str, count in neighbors[behavior].iteritems():
-                neighbor_state = self.key_to_state(neighbor_state_str)
+        for behavior_id, chain in neighbors.iteritems():
+            behavior = self.behaviors[behavior_id]
+            total = totals[behavior_id]
+            for neighbor_id, count in chain.iteritems():
                 weight = (total+1) - count
-                edges.append( (behavior, neighbor_state, weight) )
+                edges.append( (behavior, neighbor_id, weight) )
 
+        self.edges[state_id] = edges
         return edges
 
+    def transition_arrays(self):
+        if self.arrays is not None:
+            return self.arrays
+
+        num_states = len(self.table)
+        indptr = np.zeros(num_states + 1, dtype=np.int64)
+        behaviors, targets, weights = [], [], []
+        for state_id in range(num_states):
+            for behavior, neighbor_id, weight in self.neighbor_ids(state_id):
+                behaviors.append(self.behavior_ids[behavior])
+                targets.append(neighbor_id)
+                weights.append(weight)
+            indptr[state_id + 1] = len(targets)
+
+        self.arrays = (indptr, np.array(behaviors, dtype=np.int64),
+                np.array(targets, dtype=np.int64), np.array(weights, dtype=float))
+        return self.arrays
+
+    def behavior_counts(self, state_id):
+        '''
+        Get the number of transitions from a state under each behavior
+
+        state_id: int
+
+        returns: dict of string -> int
+        '''
+        self.materialize(state_id)
+        totals = self.totals.get(state_id, {})
+        return dict( (self.behaviors[b], count) for b, count in totals.iteritems() )
+
+    def materialize(self, state_id):
+        '''
+        Build the transition counts of a state from the arrays of a loaded
+        snapshot, the first time they are needed
+        '''
+        if self.stored is None or state_id in self.transitions:
+            return
+        indptr, behaviors, targets, counts = self.stored
+        if state_id >= len(indptr) - 1 or indptr[state_id] == indptr[state_id+1]:
+            return
+
+        start, end = indptr[state_id], indptr[state_id+1]
+        neighbors = {}
+        totals = {}
+        for behavior_id, neighbor_id, count in zip(behaviors[start:end].tolist(),
+                targets[start:end].tolist(), counts[start:end].tolist()):
+            neighbors.setdefault(behavior_id, {})[neighbor_id] = count
+            totals[behavior_id] = totals.get(behavior_id, 0) + count
+        self.transitions[state_id] = neighbors
+        self.totals[state_id] = totals
+
+    def snapshot(self):
+        # Transition counts in compressed sparse row layout, by state id
+        num_states = len(self.table)
+        indptr = np.zeros(num_states + 1, dtype=np.int64)
+        behaviors, targets, counts = [], [], []
+        for state_id in range(num_states):
+            self.materialize(state_id)
+            for behavior_id, chain in sorted(self.transitions.get(state_id, {}).iteritems()):
+                for neighbor_id, count in sorted(chain.iteritems()):
+                    behaviors.append(behavior_id)
+                    targets.append(neighbor_id)
+                    counts.append(count)
+            indptr[state_id + 1] = len(targets)
+
+        attributes = { 'behaviors': self.behaviors }
+        arrays = {
+            'indptr': indptr,
+            'behavior': np.array(behaviors, dtype=np.int32),
+            'target': np.array(targets, dtype=np.int32),
+            'count': np.array(counts, dtype=np.int64),
+        }
+        return attributes, arrays
+
+    def restore(self, attributes, arrays):
+        self.behaviors = [ str(b) for b in attributes['behaviors'] ]
+        self.behavior_ids = dict( (b, i) for i, b in enumerate(self.behaviors) )
+        self.transitions = {}
+        self.totals = {}
+        self.edges = {}
+        self.arrays = None
+        # Every state changed, for the path tables over the graph
+        self.state_versions = dict.fromkeys(xrange(len(self.table)), self.version + 1)
+        self.stored = (arrays['indptr'], arrays['behavior'], arrays['target'], arrays['count'])
+
+
+# Line starting a session of a transition log, written by every DotExporter
+# opening the log, followed by the time the session started
+SESSION_MARKER = '#session'
+
+def replay_transitions(filename, until=None, session=-1):
+    '''
+    Reconstruct a MarkovChainGraph from a transition log written by
+    DotExporters, as it was at the end of the given round of the given
+    session. Every exporter appending to the log starts a new session and
+    rounds restart with each session. Transitions logged before the first
+    session marker count as a session of their own.
+
+    filename: string
+    until: int, or None for the whole session
+    session: int, index of the session, negative ones counting from the
+        last session
+
+    returns: MarkovChainGraph * (float list), the graph and its initial state
+    '''
+    if session < 0:
+        with open(filename, 'r') as f:
+            sessions = 0
+            for i, line in enumerate(f):
+                if i == 0 or line.startswith(SESSION_MARKER):
+                    sessions += 1
+        session += sessions
+
+    grph = MarkovChainGraph()
+    initial_state = None
+    current = -1
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f):
+            if line.startswith(SESSION_MARKER):
+                current += 1
+                continue
+            if i == 0:
+                current += 1
+            if current < session:
+                continue
+            if current > session:
+                break
+
+            round, key, behavior, next_key = line.rstrip('\n').split('\t')
+            if until is not None and int(round) > until:
+                break
+            if initial_state is None:
+                initial_state = grph.key_to_state(key)
+            grph.add_transition(grph.state_id(grph.key_to_state(key)), behavior,
+                    grph.state_id(grph.key_to_state(next_key)))
+    return grph, initial_state
+
+
+class NullExporter():
+    '''
+    Exporter discarding the transitions given to it, for runs where no DOT
+    snapshots are wanted
+    '''
+
+    def add(self, round, sensor_state, behavior, next_sensor_state):
+        pass
+
+    def close(self):
+        pass
+
+
+class DotExporter(threading.Thread):
+    '''
+    Background writer of DOT snapshots of a growing MarkovChainGraph. The
+    control loop only queues its transitions, which the writer thread adds
+    to a replica graph of its own and appends to an append-only transition
+    log, as a new session (see replay_transitions). Every interval rounds,
+    if the graph changed, the replica is written to graph.dot and
+    graph_<round>.dot, keeping only the last retention numbered snapshots
+    this exporter wrote (all of them if None), so the snapshots of earlier
+    sessions are left alone. The graph is drawn from the first state of the
+    first transition. Use a NullExporter to export nothing.
+    '''
+
+    def __init__(self, directory='dot', interval=10, retention=100, log='transitions.log'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.interval = interval
+        self.retention = retention
+        self.graph = MarkovChainGraph()
+        self.initial_state = None
+        self.written_version = 0
+        self.written_round = 0
+        self.round = 0
+        self.written = deque()  # Numbered snapshots written, oldest first
+        self.queue = Queue.Queue()
+        self.log = None
+        if log is not None:
+            self.log = open(os.path.join(directory, log), 'a')
+            self.log.write('%s\t%s\n' % (SESSION_MARKER, datetime.datetime.now().isoformat()))
+        self.start()
+
+    def add(self, round, sensor_state, behavior, next_sensor_state):
+        '''
+        Queue a transition of the given round for export
+        '''
+        self.queue.put( (round, sensor_state, behavior, next_sensor_state) )
+
+    def close(self):
+        '''
+        Export the queued transitions and the final snapshot, and stop
+        '''
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            # Apply everything queued so far before writing anything
+            items = [item]
+            while item is not None and not self.queue.empty():
+                item = self.queue.get()
+                items.append(item)
+
+            for item in items:
+                if item is not None:
+                    self.apply(*item)
+            if self.log is not None:
+                self.log.flush()
+
+            if items[-1] is None:
+                self.snapshot()
+                if self.log is not None:
+                    self.log.close()
+                return
+            if self.round - self.written_round >= self.interval:
+                self.snapshot()
+
+    def apply(self, round, sensor_state, behavior, next_sensor_state):
+        key = self.graph.state_to_key(sensor_state)
+        next_key = self.graph.state_to_key(next_sensor_state)
+        if self.initial_state is None:
+            self.initial_state = sensor_state
+        self.graph.add_transition(self.graph.state_id(sensor_state), behavior,
+                self.graph.state_id(next_sensor_state))
+        self.round = round
+        if self.log is not None:
+            self.log.write('%d\t%s\t%s\t%s\n' % (round, key, behavior, next_key))
+
+    def snapshot(self):
+        self.written_round = self.round
+        if self.graph.version == self.written_version:
+            return
+        self.written_version = self.graph.version
+
+        self.graph.visualize(os.path.join(self.directory, 'graph.dot'), self.initial_state)
+        name = os.path.join(self.directory, 'graph_%d.dot' % self.round)
+        self.graph.visualize(name, self.initial_state)
+
+        if self.retention is not None:
+            self.written.append(name)
+            while len(self.written) > self.retention:
+                name = self.written.popleft()
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+class TransitionLog():
+    '''
+    Crash-safe incremental persistence of a MarkovChainGraph. Every
+    transition added to the graph is appended to a log segment, preceded by
+    records of the states and behaviors it introduces, and the log is synced
+    to disk every sync_every transitions. Every checkpoint_every transitions
+    the whole graph is saved as a checkpoint and a new segment is started, so
+    recovering means loading the latest checkpoint and replaying the
+    transitions logged since.
+
+    Opening a log on a directory recovers the graph saved there into the
+    given (empty) graph, and logs its changes from then on.
+    '''
+
+    STATE = 'S'
+    BEHAVIOR = 'B'
+    TRANSITION = 'T'
+    TRANSITION_FORMAT = '<iiii'
+
+    def __init__(self, directory, graph, sync_every=100, checkpoint_every=10000):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.graph = graph
+        self.sync_every = sync_every
+        self.checkpoint_every = checkpoint_every
+
+        self.generation, length = self.recover()
+
+        # Drop a record torn by a crash and carry on in the last segment
+        self.f = open(self.segment(self.generation), 'ab')
+        self.f.truncate(length)
+        self.unsynced = 0
+        self.since_checkpoint = 0
+        self.states = len(graph.table)
+        self.behaviors = len(graph.behaviors)
+        graph.log = self
+
+    def segment(self, generation):
+        return os.path.join(self.directory, 'transitions_%08d.log' % generation)
+
+    def checkpoint_file(self, generation):
+        return os.path.join(self.directory, 'checkpoint_%08d.graph' % generation)
+
+    def generations(self, pattern):
+        names = glob.glob(os.path.join(self.directory, pattern))
+        return sorted( int(name[name.rindex('_')+1:name.rindex('.')]) for name in names )
+
+    def recover(self):
+        '''
+        Load the latest checkpoint and replay the segments logged since
+
+        returns: int * int, the generation and valid length of the last
+            segment
+        '''
+        generation = 0
+        checkpoints = self.generations('checkpoint_*.graph')
+        if len(checkpoints) > 0:
+            generation = checkpoints[-1]
+            self.graph.load(self.checkpoint_file(generation))
+
+        length = 0
+        for segment in self.generations('transitions_*.log'):
+            if segment >= generation:
+                generation = segment
+                length = self.replay(self.segment(segment))
+        return generation, length
+
+    def replay(self, filename):
+        '''
+        Apply the records of a segment to the graph
+
+        returns: int, the length of the segment up to its last whole record
+        '''
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        grph = self.graph
+        transition_size = struct.calcsize(self.TRANSITION_FORMAT)
+        position = 0
+        while position < len(data):
+            kind = data[position]
+            if kind == self.TRANSITION:
+                end = position + 1 + transition_size
+                if end > len(data):
+                    break
+                state_id, behavior_id, next_state_id, count = struct.unpack(
+                        self.TRANSITION_FORMAT, data[position+1:end])
+                grph.add_transition(state_id, grph.behaviors[behavior_id], next_state_id, count)
+            elif kind in (self.STATE, self.BEHAVIOR):
+                if position + 5 > len(data):
+                    break
+                length, = struct.unpack('<I', data[position+1:position+5])
+                end = position + 5 + length
+                if end > len(data):
+                    break
+                name = data[position+5:end]
+                if kind == self.STATE:
+                    expected = len(grph.table)
+                    state_id = grph.table.intern(name, grph.key_to_state(name))
+                else:
+                    expected = len(grph.behaviors)
+                    state_id = grph.behavior_id(name)
+                if state_id != expected:
+                    raise Exception('Corrupt transition log %s at %d' % (filename, position))
+            else:
+                raise Exception('Corrupt transition log %s at %d' % (filename, position))
+            position = end
+        return position
+
+    def transition(self, state_id, behavior_id, next_state_id, count):
+        '''
+        Log a transition added to the graph
+        '''
+        grph = self.graph
+        for i in xrange(self.states, len(grph.table)):
+            self.record(self.STATE, grph.table.keys[i])
+        self.states = len(grph.table)
+        for i in xrange(self.behaviors, len(grph.behaviors)):
+            self.record(self.BEHAVIOR, grph.behaviors[i])
+        self.behaviors = len(grph.behaviors)
+
+        self.f.write(self.TRANSITION + struct.pack(self.TRANSITION_FORMAT,
+            state_id, behavior_id, next_state_id, count))
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+        self.since_checkpoint += 1
+        if self.since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def record(self, kind, name):
+        self.f.write(kind + struct.pack('<I', len(name)) + name)
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def checkpoint(self):
+        '''
+        Save the whole graph and start a new segment, dropping the older ones
+        '''
+        self.sync()
+        self.f.close()
+        self.generation += 1
+        self.f = open(self.segment(self.generation), 'wb')
+        self.since_checkpoint = 0
+
+        filename = self.checkpoint_file(self.generation)
+        self.graph.save(filename + '.tmp')
+        with open(filename + '.tmp', 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(filename + '.tmp', filename)
+
+        for generation in self.generations('checkpoint_*.graph'):
+            if generation < self.generation:
+                os.remove(self.checkpoint_file(generation))
+        for generation in self.generations('transitions_*.log'):
+            if generation < self.generation:
+                os.remove(self.segment(generation))
+
+    def close(self):
+        self.sync()
+        self.f.close()
+        self.graph.log = None
+
 
 class ANNGraph(Graph):
 
     def __init__(self, round_output=False, training_callback=None):
+        Graph.__init__(self)
         self.round_output = round_output
         self.training_callback = training_callback
         self.behaviors = ['explore', 'faceObject', 'tryGrab', 'release']
@@ -156,12 +884,11 @@ class ANNGraph(Graph):
             items.append( float(b == behavior) )
         return items
 
-    def construct(self, sensor_states, behaviors):
-
-        input_len = len(sensor_states[0])
+    def build_network(self, input_len):
         state_len = input_len + len(self._behavior_to_list(''))
 
         # Initialize the network
+        self.input_len = input_len
         self.net = FeedForwardNetwork()
 
         input_layer = SigmoidLayer(state_len)
@@ -180,6 +907,12 @@ class ANNGraph(Graph):
 
         self.net.sortModules()
 
+    def construct(self, sensor_states, behaviors):
+
+        input_len = len(sensor_states[0])
+        state_len = input_len + len(self._behavior_to_list(''))
+        self.build_network(input_len)
+
         # Build the data set
         ds = SupervisedDataSet(state_len, input_len)
 
@@ -203,11 +936,25 @@ class ANNGraph(Graph):
             if self.training_callback is not None:
                 self.training_callback(i, self)
 
+    def snapshot(self):
+        attributes = {
+            'round_output': self.round_output,
+            'behaviors': self.behaviors,
+            'input_len': self.input_len,
+        }
+        return attributes, { 'params': np.asarray(self.net.params) }
+
+    def restore(self, attributes, arrays):
+        self.round_output = attributes['round_output']
+        self.behaviors = [ str(b) for b in attributes['behaviors'] ]
+        self.build_network(attributes['input_len'])
+        self.net.params[:] = arrays['params']
+
     def neighbors(self, sensor_state):
         # A neighbor exists for each behavior
         edges = []
         for behavior in self.behaviors:
-            neighbor_state = self.net.activate( sensor_state + self._behavior_to_list(behavior) )
+            neighbor_state = list(self.net.activate( sensor_state + self._behavior_to_list(behavior) ))
             if self.round_output:
                 neighbor_state = map(round, neighbor_state)
             edges.append( (behavior, neighbor_state, 1) )
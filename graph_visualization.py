@@ -22,9 +22,9 @@ if __name__ == '__main__':
 
     discretizer = discretization.SimplifyingDiscretizer()
 
-    sensor_states, behaviors = dataloader.load('test.out')
-    norm_sensor_states = map(normalization.normalize, sensor_states)
-    disc_sensor_states = map(discretizer.discretize, norm_sensor_states)
+    sensor_states, behaviors = dataloader.open_log('test.out')
+    norm_sensor_states = normalization.normalize_many(sensor_states)
+    disc_sensor_states = discretizer.discretize_many(norm_sensor_states).tolist()
 
     for data_length in [10, 50, 100, 300, 1000, 10000]:
         s = disc_sensor_states[:data_length]
@@ -36,7 +36,7 @@ if __name__ == '__main__':
             filename = '%s/%06d' % (ann_trace_output_dir, i)
             grph.visualize(filename+'.dot', s[0])
             subprocess.call(['dot', '-Tpng', '-o', filename+'.png', filename+'.dot'])
-            grph.save(filename+'.pickle')
+            grph.save(filename+'.graph')
 
         visualize(graph.MarkovChainGraph(), "markov", output_dir, s, b)
         visualize(graph.ANNGraph(round_output=True, training_callback=ann_callback), "ann", output_dir, s, b)
@@ -1,19 +1,32 @@
+import numpy as np
+
+PROX = (0.0, 4500.0)
+GROUND = (0.0, 1000.0)
+ACC = (-32.0, 32.0)
+MIC = (0.0, 255.0)
+
+# The channels of a normalized sensor state, in order: the sensor state key,
+# its (min, max) range and the values of the channel that are included. The
+# lasso state is appended as the last value.
+SCHEMA = [
+    ('frontSensors', PROX, slice(None)),
+    ('rearSensors', PROX, slice(None)),
+    ('groundSensors', GROUND, slice(-1, None)),
+    #('accelerometer', ACC, slice(None)),
+    #('micIntensity', MIC, slice(None)),
+]
+
 def normalize(sensor_state):
     def _norm(min_value, max_value):
         return (lambda value: float(value + min_value) / float(max_value - min_value))
 
-    prox = [0.0, 4500.0]
-    ground = [0.0, 1000.0]
-    acc = [-32.0, 32.0]
-    mic = [0.0, 255.0]
-
     values = []
 
-    values += map(_norm(*prox), sensor_state["frontSensors"])
-    values += map(_norm(*prox), sensor_state["rearSensors"])
-    values += map(_norm(*ground), sensor_state["groundSensors"][-1:])
-    #values += map(_norm(*acc), sensor_state["accelerometer"])
-    #values += map(_norm(*mic), [sensor_state["micIntensity"]])
+    for key, value_range, included in SCHEMA:
+        channel = sensor_state[key]
+        if not isinstance(channel, (list, tuple)):
+            channel = [channel]
+        values += map(_norm(*value_range), channel[included])
 
     if sensor_state["lassoState"] == 'down':
         values.append(1.0)
@@ -22,6 +35,33 @@ def normalize(sensor_state):
 
     return values
 
+def normalize_many(sensor_states):
+    '''
+    Normalize a batch of sensor states into an N x D array in one vectorized
+    step. Row i equals normalize of sensor state i.
+
+    sensor_states: dict list, or a mapping of sensor state keys to arrays of
+        N records such as a dataloader.ColumnarLog (lasso state 1 if down)
+
+    returns: N x D array
+    '''
+    if hasattr(sensor_states, 'keys'):
+        columns = sensor_states
+        lasso = np.asarray(columns['lassoState']) != 0
+    else:
+        columns = dict( (key, [ s[key] for s in sensor_states ]) for key, _, _ in SCHEMA )
+        lasso = np.array([ s['lassoState'] == 'down' for s in sensor_states ], dtype=bool)
+
+    parts = []
+    for key, (min_value, max_value), included in SCHEMA:
+        channel = np.asarray(columns[key], dtype=float)
+        if channel.ndim == 1:
+            channel = channel[:, np.newaxis]
+        parts.append( (channel[:, included] + min_value) / (max_value - min_value) )
+    parts.append( lasso.astype(float).reshape(-1, 1) )
+
+    return np.hstack(parts)
+
 # Application entry point
 if __name__ == '__main__':
     data = {
@@ -34,13 +34,13 @@ class FindStateProblem(Problem):
 
     def __init__(self, goal_state):
         self.goal_state = goal_state
+        self.graph = Graph()
 
     def required_state_sequence_length(self):
         return 1
 
     def evaluate(self, sensor_states):
-        graph = Graph()
-        if self.goal_state == graph.state_to_key(sensor_states[0]):
+        if self.goal_state == self.graph.state_to_key(sensor_states[0]):
             return 1
 
         return 0
@@ -50,16 +50,19 @@ class FindStateProblem(Problem):
 
 class FindUnexploredStateProblem(Problem):
 
-    def __init__(self, state_behaviors,  min_count):
-        self.state_behaviors = state_behaviors
+    def __init__(self, visits,  min_count):
+        self.visits = visits  # counters.VisitCounters
         self.min_count = min_count  
+        self.graph = Graph()
 
     def required_state_sequence_length(self):
         return 1
 
     def evaluate(self, sensor_states):
-        graph = Graph()
-        sensor_count = self.state_behaviors[graph.state_to_key(sensor_states[0])]["count"]
+        state_id = self.visits.table.lookup(self.graph.state_to_key(sensor_states[0]))
+        if state_id is None or state_id not in self.visits:
+            return 0
+        sensor_count = self.visits.total(state_id)
         if abs(self.min_count - sensor_count) < 10:
             return 1
 
@@ -0,0 +1,154 @@
+import sys, os, time, random, hashlib
+import numpy as np
+import dataloader
+
+class Trace():
+    '''
+    The behaviors an algorithm chose while replaying a log and the wall clock
+    latency of each call
+    '''
+
+    def __init__(self):
+        self.behaviors = []
+        self.latencies = []
+
+    def __len__(self):
+        return len(self.behaviors)
+
+    def record(self, behavior, latency):
+        self.behaviors.append(behavior)
+        self.latencies.append(latency)
+
+    def digest(self):
+        '''
+        Get a fingerprint of the chosen behaviors, equal for equal traces
+        '''
+        return hashlib.sha1('\n'.join(self.behaviors)).hexdigest()
+
+    def summary(self):
+        '''
+        Get the number of calls, the total time in seconds, the mean, median,
+        95th percentile and maximum latency in milliseconds and the calls per
+        second. The latency statistics of an empty trace are NaN.
+
+        returns: dict of string -> number
+        '''
+        if len(self.latencies) == 0:
+            nan = float('nan')
+            return { 'calls': 0, 'total': 0.0, 'mean': nan, 'median': nan,
+                    'p95': nan, 'max': nan, 'rate': 0.0 }
+
+        latencies = np.asarray(self.latencies) * 1e3
+        total = latencies.sum() / 1e3
+        return {
+            'calls': len(latencies),
+            'total': total,
+            'mean': latencies.mean(),
+            'median': np.percentile(latencies, 50),
+            'p95': np.percentile(latencies, 95),
+            'max': latencies.max(),
+            'rate': len(latencies) / total if total > 0 else float('inf'),
+        }
+
+
+def sensor_stream(filename):
+    '''
+    Stream the sensor states of a text or columnar collector log
+
+    returns: dict generator
+    '''
+    if os.path.isdir(filename):
+        return dataloader.ColumnarLog(filename).sensor_states()
+    return ( sensor_state for sensor_state, _ in dataloader.iter_load(filename) )
+
+def replay(algorithm, sensor_states, limit=None, seed=0, quiet=True):
+    '''
+    Feed recorded sensor states through an algorithm as Behaviors would, the
+    first one through getInitialState and the rest through eventHandler, as
+    fast as possible and without a robot. The random number generators are
+    seeded first so replays are reproducible. Replay ends at the end of the
+    log, after limit calls or when the algorithm chooses to stop.
+
+    algorithm: algorithm object
+    sensor_states: dict iterable
+    limit: int, or None for the whole log
+    seed: int
+    quiet: bool, whether to silence what the algorithm prints
+
+    returns: Trace
+    '''
+    random.seed(seed)
+    np.random.seed(seed)
+
+    trace = Trace()
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        state = None
+        for sensor_state in sensor_states:
+            if limit is not None and len(trace) >= limit:
+                break
+            t = time.time()
+            if state is None:
+                state = algorithm.getInitialState(sensor_state)
+            else:
+                state = algorithm.eventHandler(state, sensor_state, None)
+            trace.record(state, time.time() - t)
+            if state == "stop":
+                break
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return trace
+
+
+def algorithm(name, filename):
+    from algorithms import SmartCollector, NaiveCollector, ObjectHomer, RandomCollector, ProblemSolver
+    from discretization import SimplifyingDiscretizer
+    from graph import MarkovChainGraph, NullExporter
+    from search import BestFirstSearch
+    from problem import BallPickupProblem
+
+    if name == 'smart':
+        return SmartCollector(open(os.devnull, 'w'), SimplifyingDiscretizer(), NullExporter())
+    if name == 'naive':
+        return NaiveCollector(open(os.devnull, 'w'), SimplifyingDiscretizer())
+    if name == 'random':
+        return RandomCollector(open(os.devnull, 'w'))
+    if name == 'homer':
+        return ObjectHomer()
+    if name == 'solver':
+        # Plan on a graph of the replayed log itself
+        sensorStates, behaviors = dataloader.open_log(filename)
+        return ProblemSolver(SimplifyingDiscretizer(), MarkovChainGraph(),
+                BestFirstSearch(), BallPickupProblem(), sensorStates, behaviors)
+    raise Exception('Unknown algorithm %s' % name)
+
+# Application entry point
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python replay.py <log file or columnar log directory> <smart|naive|random|homer|solver> [limit]')
+        sys.exit(1)
+    filename = sys.argv[1]
+    limit = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        alg = algorithm(sys.argv[2], filename)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    trace = replay(alg, sensor_stream(filename), limit)
+    if hasattr(alg, 'close'):
+        alg.close()
+    summary = trace.summary()
+    print('%8s %10s %10s %10s %10s %10s %12s' % ('calls', 'total (s)', 'mean (ms)',
+        'median', 'p95', 'max', 'calls/s'))
+    print('%8d %10.2f %10.3f %10.3f %10.3f %10.3f %12.1f' % (summary['calls'],
+        summary['total'], summary['mean'], summary['median'], summary['p95'],
+        summary['max'], summary['rate']))
+    print('behaviors: %s' % trace.digest())
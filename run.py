@@ -1,20 +1,23 @@
 import signal, sys, time
 
 from thymio_api import ThymioAPI
-from behaviors import Behaviors
+from behaviors import Behaviors, PipelinedBehaviors
 from algorithms import ColorTraveller, ObjectHomer, RandomCollector, ProblemSolver, SmartCollector
 from graph import MarkovChainGraph, ANNGraph
-from discretization import SOMDiscretizer, RoundingDiscretizer, SimplifyingDiscretizer, KMeansDiscretizer
-from search import DepthFirstSearch, RandomWalkSearch
+from discretization import SOMDiscretizer, RoundingDiscretizer, SimplifyingDiscretizer, KMeansDiscretizer, DiscretizerCache
+from search import DepthFirstSearch, RandomWalkSearch, BestFirstSearch
 from problem import BallPickupProblem
 from normalization import normalize
 import dataloader
     
 if __name__ == '__main__':
     robot = ThymioAPI() 
+    robot.startSampler()
 
     def signal_handler(signal, frame):
         robot.forward(1)
+        if hasattr(algorithm, 'close'):
+            algorithm.close()
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -22,18 +25,21 @@ if __name__ == '__main__':
         #algorithm = ColorTraveller()
         #algorithm = ObjectHomer()
         #algorithm = RandomCollector(f)
-        algorithm = SmartCollector(f, SimplifyingDiscretizer())
+        algorithm = SmartCollector(f, SimplifyingDiscretizer(), graphLogDirectory='graph_log')
         behaviors = Behaviors(robot, algorithm)
+        #behaviors = PipelinedBehaviors(robot, algorithm)
         behaviors.run()
 
     #sensorStates, behaviors = dataloader.load("test.out")
     #discretizer = SOMDiscretizer()
+    #discretizer = SOMDiscretizer(training='batch', cache=DiscretizerCache())
     #discretizer = RoundingDiscretizer()
     #discretizer = SimplifyingDiscretizer()
     #discretizer = KMeansDiscretizer(5)
     #graph = MarkovChainGraph()
     #graph = ANNGraph(round_output=True)
     #search = DepthFirstSearch()
+    #search = BestFirstSearch()
     #search = RandomWalkSearch()
     #problem = BallPickupProblem()
 
@@ -1,8 +1,32 @@
-import random
+import random, heapq, itertools, multiprocessing
+import numpy as np
+from collections import OrderedDict
 from sys import maxint
 
 minint = -maxint - 1
 
+def traversal(graph):
+    '''
+    Get how to search a graph: the functions giving the node of a sensor
+    state, the (behavior, node, weight) neighbors of a node and the sensor
+    state of a node. Graphs with a finite transition table are searched over
+    state ids, which they intern anyway. Other graphs, such as ANNGraph, are
+    searched over the sensor states themselves (as tuples, to be hashable),
+    so searching neither grows their state table nor rounds the states
+    through their keys.
+
+    graph: Graph
+
+    returns: (function, function, function)
+    '''
+    if graph.finite:
+        return graph.state_id, graph.neighbor_ids, graph.state
+
+    def neighbors(node):
+        return [ (b, tuple(s), w) for b, s, w in graph.neighbors(list(node)) ]
+    return tuple, neighbors, list
+
+
 class Search():
 
     def choose_behavior(self, sensor_state_history, graph, problem):
@@ -23,6 +47,9 @@ class DepthFirstSearch(Search):
 
     def choose_behavior(self, sensor_state_history, graph, problem):
 
+        n = problem.required_state_sequence_length()
+        node, neighbors, state = traversal(graph)
+
         # Define an auxiliary function for recursive graph traversal
         def traverse(states, weight, path, limit):
             if limit == 0:
@@ -30,8 +57,7 @@ class DepthFirstSearch(Search):
 
 
             # Get the subsequence of states used for evaluation
-            n = problem.required_state_sequence_length()
-            eval_seq = states[-n:]
+            eval_seq = map(state, states[-n:])
 
             # Initiate the computed paths
             paths = []
@@ -43,12 +69,14 @@ class DepthFirstSearch(Search):
 
             # Search the neighborhood recursively
             current_state = states[-1]
-            for b, s, w in graph.neighbors(current_state):
+            for b, s, w in neighbors(current_state):
                     paths.extend( traverse(states + [s], weight + w, path + [b], limit - 1) )
             
             return paths
         
-        paths = traverse(sensor_state_history, 0, [], 4)
+        # Only the last n states are ever evaluated
+        history = map(node, sensor_state_history[-n:])
+        paths = traverse(history, 0, [], 4)
 
         if len(paths) == 0:
             return ("explore", minint)
@@ -64,61 +92,448 @@ class DepthFirstSearch(Search):
         return (best_path[2][0], best_eval)
 
 
+class BestFirstSearch(Search):
+    '''
+    Uniform cost search: paths are expanded in order of accumulated edge weight
+    and every sequence of the last n states (n being the problem's required
+    state sequence length) is expanded at most once. The cost grows with the
+    number of states reachable within the horizon instead of branching^depth,
+    so much deeper horizons than DepthFirstSearch are affordable. As with
+    DepthFirstSearch the best evaluation wins, ties going to the lowest weight.
+    The search stops at the first goal, assuming goals evaluate highest.
+
+    Since a node reached cheaply is never expanded again, a costlier but
+    shorter path to it is not continued, which can hide a few states right at
+    the horizon.
+    '''
+
+    def __init__(self, search_depth=15):
+        self.search_depth = search_depth
+
+    def choose_behavior(self, sensor_state_history, graph, problem):
+        n = problem.required_state_sequence_length()
+        node, neighbors, state = traversal(graph)
+        history = tuple(map(node, sensor_state_history[-n:]))
+
+        # Queue entries: weight, insertion order, last n nodes, first
+        # behavior of the path, depth
+        order = itertools.count()
+        queue = []
+        visited = set()
+
+        def expand(nodes, weight, first_behavior, depth):
+            if depth == self.search_depth:
+                return
+            for b, s, w in neighbors(nodes[-1]):
+                child = (nodes + (s,))[-n:]
+                if child not in visited:
+                    heapq.heappush(queue, (weight + w, next(order), child,
+                        first_behavior or b, depth + 1))
+
+        expand(history, 0, None, 0)
+
+        best_eval = minint
+        best_weight = maxint
+        best_behaviors = []
+        while len(queue) > 0:
+            weight, _, nodes, first_behavior, depth = heapq.heappop(queue)
+            if nodes in visited:
+                continue
+            visited.add(nodes)
+
+            # Nodes are popped by increasing weight, so an evaluation only
+            # ties the best one if it was reached at the same weight
+            eval_seq = map(state, nodes)
+            e = problem.evaluate(eval_seq)
+            if e > best_eval:
+                best_eval, best_weight, best_behaviors = e, weight, [first_behavior]
+            elif e == best_eval and weight == best_weight:
+                best_behaviors.append(first_behavior)
+
+            if problem.goal(eval_seq):
+                break
+
+            expand(nodes, weight, first_behavior, depth)
+
+        if len(best_behaviors) == 0:
+            return ("explore", minint)
+
+        return (random.choice(best_behaviors), best_eval)
+
+
+def simulate_walks(arrays, first_edges, num_walks, depth, seed):
+    '''
+    Simulate random walks over a graph's transition arrays (see
+    Graph.transition_arrays), all walks advancing one step at a time. The
+    first step of every walk is drawn from the given edges, every later step
+    uniformly from the edges leaving the current state. A walk ends early at a
+    state without outgoing edges.
+
+    arrays: (int array, int array, int array, float array)
+    first_edges: int array of edge indices
+    num_walks: int
+    depth: int
+    seed: int
+
+    returns: (int array, float array) -- num_walks x depth state ids (-1 after
+        a walk ended) and accumulated weights
+    '''
+    indptr, _, targets, weights = arrays
+    rng = np.random.RandomState(seed)
+
+    paths = np.empty((num_walks, depth), dtype=np.int64)
+    paths.fill(-1)
+    costs = np.zeros((num_walks, depth))
+
+    edges = first_edges[rng.randint(len(first_edges), size=num_walks)]
+    current = targets[edges]
+    cost = weights[edges]
+    paths[:, 0] = current
+    costs[:, 0] = cost
+
+    alive = np.ones(num_walks, dtype=bool)
+    for step in range(1, depth):
+        degree = indptr[current + 1] - indptr[current]
+        alive &= degree > 0
+        if not alive.any():
+            break
+
+        # Dead walks pick edge 0, their results are masked out below
+        offsets = (rng.random_sample(num_walks) * degree).astype(np.int64)
+        edges = np.where(alive, indptr[current] + offsets, 0)
+        current = np.where(alive, targets[edges], current)
+        cost = np.where(alive, cost + weights[edges], cost)
+
+        paths[alive, step] = current[alive]
+        costs[alive, step] = cost[alive]
+
+    return paths, costs
+
+
+def simulate_walk_chunks(task):
+    '''
+    Simulate several chunks of walks over the same transition arrays, for
+    running in a worker process that receives the arrays once per decision
+
+    task: (arrays, ((int array * int * int) list), int) -- transition arrays,
+        (first edges, number of walks, seed) per chunk, walk depth
+
+    returns: (int array, float array) list -- the walks of each chunk
+    '''
+    arrays, chunks, depth = task
+    return [ simulate_walks(arrays, first_edges, num_walks, depth, seed)
+        for first_edges, num_walks, seed in chunks ]
+
+
 class RandomWalkSearch(Search):
+    '''
+    Monte-Carlo search: for every behavior a number of random walks starting
+    with that behavior are simulated, and each walk scores the best evaluation
+    along it (ties going to the lowest accumulated weight). The behavior with
+    the best mean score wins, its mean evaluation is returned.
+
+    On graphs exposing transition arrays, and for problems evaluating single
+    states, all walks of a behavior are simulated at once with NumPy and every
+    visited state is evaluated only once, so thousands of walks per decision
+    are affordable. Other graphs fall back to walking one path at a time.
 
-    def __init__(self, walks_per_behavior=5, search_depth=30):
+    The vectorized walks are split into chunks of chunk_size walks with their
+    own seeds. Given workers > 1 the chunks are spread over a process pool,
+    each worker receiving the transition arrays once per decision. Since the
+    chunks and seeds do not depend on the number of workers, a fixed seed
+    gives the same choices for any number of workers.
+    '''
+
+    def __init__(self, walks_per_behavior=5, search_depth=30, seed=None, workers=None, chunk_size=500):
         self.walks_per_behavior = walks_per_behavior
         self.search_depth = search_depth
         self.behaviors = ['explore', 'faceObject', 'tryGrab', 'release']
+        self.random = np.random.RandomState(seed)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.pool = None
+
+    def close(self):
+        '''
+        Shut down the worker processes, if any
+
+        returns: None
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def choose_behavior(self, sensor_state_history, graph, problem):
+        n = problem.required_state_sequence_length()
+        node, neighbors, state = traversal(graph)
+        history = map(node, sensor_state_history[-n:])
+
+        arrays = graph.transition_arrays() if graph.finite else None
+        if arrays is not None and n == 1:
+            scores = self.rollouts(history[-1], arrays, graph, problem)
+        else:
+            scores = self.walks(history, neighbors, state, problem)
+
+        # Highest mean evaluation, then lowest mean weight
+        best_behavior = "explore"
+        best_e = minint
+        best_w = maxint
+        for behavior in self.behaviors:
+            if behavior not in scores:
+                continue
+            e, w = scores[behavior]
+            if e > best_e or (e == best_e and w < best_w):
+                best_behavior = behavior
+                best_e, best_w = e, w
+
+        return (best_behavior, best_e)
+
+    def rollouts(self, start, arrays, graph, problem):
+        '''
+        Score the behaviors leaving the start state id with vectorized walks
+
+        returns: dict of behavior -> (mean evaluation, mean weight)
+        '''
+        indptr, edge_behaviors, _, _ = arrays
+        if start + 1 >= len(indptr):
+            return {}
+        start_edges = np.arange(indptr[start], indptr[start + 1])
+
+        chunk_behaviors = []
+        chunks = []
+        for behavior in self.behaviors:
+            behavior_id = graph.behavior_ids.get(behavior)
+            if behavior_id is None:
+                continue
+            first_edges = start_edges[edge_behaviors[start_edges] == behavior_id]
+            if len(first_edges) == 0:
+                continue
+            for i in range(0, self.walks_per_behavior, self.chunk_size):
+                num_walks = min(self.chunk_size, self.walks_per_behavior - i)
+                chunk_behaviors.append(behavior)
+                chunks.append( (first_edges, num_walks, self.random.randint(2**31 - 1)) )
+
+        walks = {}
+        for behavior, (paths, costs) in zip(chunk_behaviors, self.simulate(arrays, chunks)):
+            if behavior in walks:
+                walks[behavior] = (np.vstack([ walks[behavior][0], paths ]),
+                        np.vstack([ walks[behavior][1], costs ]))
+            else:
+                walks[behavior] = (paths, costs)
+
+        # Evaluate every state visited by any walk once
+        visited = np.unique(np.concatenate([ paths.ravel() for paths, _ in walks.values() ] + [ [-1] ]))
+        values = np.empty(len(indptr))
+        values.fill(-np.inf)
+        for state_id in visited[visited >= 0]:
+            values[state_id] = problem.evaluate([ graph.state(state_id) ])
+
+        scores = {}
+        for behavior, (paths, costs) in walks.iteritems():
+            # values[-1] is -inf, so ended walks never score
+            evaluations = values[paths]
+            best = evaluations.max(axis=1)
+            first_best = np.argmax(evaluations == best[:, np.newaxis], axis=1)
+            weight = costs[np.arange(len(paths)), first_best]
+            scores[behavior] = (best.mean(), weight.mean())
+        return scores
+
+    def simulate(self, arrays, chunks):
+        '''
+        Simulate the given chunks of walks, in the worker processes if any
+
+        arrays: (int array, int array, int array, float array)
+        chunks: (int array * int * int) list -- first edges, number of walks,
+            seed
+
+        returns: (int array, float array) list -- the walks of each chunk
+        '''
+        if self.workers is None or self.workers <= 1 or len(chunks) <= 1:
+            return simulate_walk_chunks( (arrays, chunks, self.search_depth) )
+
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+
+        # Worker i gets chunks i, i + workers, ..., and the arrays only once
+        tasks = [ (arrays, chunks[i::self.workers], self.search_depth)
+            for i in range(min(self.workers, len(chunks))) ]
+        results = self.pool.map(simulate_walk_chunks, tasks)
+
+        walks = [ None ] * len(chunks)
+        for i, task_walks in enumerate(results):
+            walks[i::self.workers] = task_walks
+        return walks
+
+    def walks(self, history, neighbors, state, problem):
+        '''
+        Score the behaviors leaving the last node of the history (see
+        traversal) by walking one random path at a time
+
+        returns: dict of behavior -> (mean evaluation, mean weight)
+        '''
+        n = problem.required_state_sequence_length()
 
         # Define an auxiliary function for recursive graph traversal
-        def traverse(states, weight, path, limit):
+        def traverse(states, weight, path, limit, behavior):
             if limit == 0:
                 return minint, maxint
 
             # Get the subsequence of states used for evaluation
-            n = problem.required_state_sequence_length()
-            eval_seq = states[-n:]
+            eval_seq = map(state, states[-n:])
             
 
-            # Choose a neighbor for recursive search
+            # Choose a neighbor for recursive search, the first step being
+            # the behavior under consideration
             current_state = states[-1]
-            neighbors = graph.neighbors(current_state)
-
-            if len(neighbors) == 0:
-                return minint, maxint
+            edges = neighbors(current_state)
+            if len(path) == 0:
+                edges = filter(lambda x: x[0] == behavior, edges)
 
-            choice = random.choice(neighbors)
-
-            b, s, w = choice
-            best_e, best_w = traverse(states + [s], weight + w, path + [b], limit - 1)
+            if len(edges) > 0:
+                b, s, w = edges[self.random.randint(len(edges))]
+                best_e, best_w = traverse(states + [s], weight + w, path + [b], limit - 1, behavior)
+            else:
+                best_e, best_w = minint, maxint
 
             # Evaluate the current path
             if len(path) > 0:
                 e = problem.evaluate(eval_seq)
-                current_path = ( e, weight, path )
-                if e > best_e or (e == best_e and w < best_w):
-                    return e, w
+                if e > best_e or (e == best_e and weight < best_w):
+                    return e, weight
                 else:
                     return best_e, best_w
             else:
                 return best_e, best_w
-            
+
         # Do the random walks
-        best_behavior = "explore"
-        best_e = minint
-        best_w = maxint
+        scores = {}
         for behavior in self.behaviors:
-            for i in range(self.walks_per_behavior):
-                e, w = traverse(sensor_state_history, 0, [], self.search_depth)
-                if e > best_e or (e == best_e and w < best_w):
-                    best_behavior = behavior
-                    best_e, best_w = e, w
+            results = [ traverse(history, 0, [], self.search_depth + 1, behavior)
+                for i in range(self.walks_per_behavior) ]
+            results = filter(lambda x: x[0] != minint, results)
+            if len(results) > 0:
+                scores[behavior] = (np.mean([ e for e, w in results ]),
+                        np.mean([ w for e, w in results ]))
+        return scores
+
+
+class ShortestPathTable():
+    '''
+    Next-hop tables towards goal states over a graph with state versions
+    (such as MarkovChainGraph). The table of a goal is built once with
+    Dijkstra over the reversed edges, giving the distance to the goal and the
+    first edge (behavior, next state id) towards it from every state that can
+    reach it. As long as the goal stays the same, queries are dictionary
+    lookups.
+
+    Transitions only ever add edges and shift weights, so a table is kept
+    until it is refresh_every queries old, until the cached first edge of the
+    queried state is no longer an edge of the graph, or until a state missing
+    from it gets new transitions of its own. Only the tables of the last
+    capacity goals queried are kept.
+    '''
+
+    def __init__(self, graph, refresh_every=50, capacity=2):
+        self.graph = graph
+        self.refresh_every = refresh_every
+        self.capacity = capacity
+        self.tables = OrderedDict()  # Goal state id -> [Graph version, Queries, Distances, First edges]
+        self.builds = 0
+
+    def table(self, state_id, goal_state_id):
+        '''
+        Get the distances to and first edges towards the given goal state id,
+        refreshing them if they may be out of date for the given state id
+
+        state_id: int
+        goal_state_id: int
+
+        returns: (dict of int -> float, dict of int -> (string * int))
+        '''
+        cached = self.tables.pop(goal_state_id, None)
+        if cached is not None and not self.outdated(cached, state_id):
+            cached[1] += 1
+        else:
+            distances, hops = self.dijkstra(goal_state_id)
+            cached = [ self.graph.version, 1, distances, hops ]
+            self.builds += 1
+
+        # Most recently used last, the least recently used table goes first
+        self.tables[goal_state_id] = cached
+        while len(self.tables) > self.capacity:
+            self.tables.popitem(last=False)
+        return cached[2], cached[3]
+
+    def outdated(self, cached, state_id):
+        version, queries, distances, hops = cached
+        if queries >= self.refresh_every:
+            return True
+        hop = hops.get(state_id)
+        if hop is None:
+            return self.graph.state_versions.get(state_id, 0) > version
+        behavior, next_state_id = hop
+        return not any(b == behavior and s == next_state_id
+                for b, s, w in self.graph.neighbor_ids(state_id))
+
+    def discard(self, goal_state_id):
+        '''
+        Drop the table of a goal that will not be searched for anymore
+
+        goal_state_id: int
+
+        returns: None
+        '''
+        self.tables.pop(goal_state_id, None)
+
+    def dijkstra(self, goal_state_id):
+        # Predecessors of every state: state id -> (behavior, state id, weight) list
+        predecessors = {}
+        for state_id in range(len(self.graph.table)):
+            for b, s, w in self.graph.neighbor_ids(state_id):
+                predecessors.setdefault(s, []).append( (b, state_id, w) )
+
+        distances = { goal_state_id: 0 }
+        hops = {}
+        done = set()
+        queue = [ (0, goal_state_id) ]
+        while len(queue) > 0:
+            distance, current = heapq.heappop(queue)
+            if current in done:
+                continue
+            done.add(current)
+
+            for b, s, w in predecessors.get(current, []):
+                if s not in done and distance + w < distances.get(s, maxint):
+                    distances[s] = distance + w
+                    hops[s] = (b, current)
+                    heapq.heappush(queue, (distance + w, s))
+
+        return distances, hops
+
+    def next_behavior(self, state_id, goal_state_id):
+        '''
+        Get the first behavior of the cheapest path between two state ids
+
+        state_id: int
+        goal_state_id: int
+
+        returns: string, or None if the goal is the state or unreachable
+        '''
+        hop = self.table(state_id, goal_state_id)[1].get(state_id)
+        return hop[0] if hop is not None else None
+
+    def distance(self, state_id, goal_state_id):
+        '''
+        Get the weight of the cheapest path between two state ids
+
+        state_id: int
+        goal_state_id: int
+
+        returns: float, or None if the goal is unreachable
+        '''
+        return self.table(state_id, goal_state_id)[0].get(state_id)
 
-        return (best_behavior, best_e)
-		
 
 # Application entry point
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import sys, os, time, random, multiprocessing
+import graph, search, problem
+
+behaviors = ['explore', 'faceObject', 'tryGrab', 'release']
+
+def synthetic_graph(num_states, outcomes=3, samples=5, seed=0):
+    '''
+    A MarkovChainGraph over num_states states where every behavior leads to
+    one of outcomes random states, observed samples times per behavior
+    '''
+    rng = random.Random(seed)
+    grph = graph.MarkovChainGraph()
+    states = [ [float(i), 0.0] for i in range(num_states) ]
+    for state in states:
+        for behavior in behaviors:
+            targets = [ rng.choice(states) for i in range(outcomes) ]
+            for i in range(samples):
+                grph.construct([state, rng.choice(targets)], [behavior])
+    return grph, states
+
+def measure(srch, grph, history, prblm, repeat=3):
+    '''
+    Best wall clock time and the result of choosing a behavior, with the
+    search output silenced
+    '''
+    best = None
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for i in range(repeat):
+            t1 = time.time()
+            result = srch.choose_behavior(history, grph, prblm)
+            t2 = time.time()
+            if best is None or t2 - t1 < best:
+                best = t2 - t1
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return best, result
+
+if __name__ == '__main__':
+    print('%8s %12s %12s %12s %12s' % ('states', 'dfs-3 (ms)', 'bfs-3 (ms)', 'bfs-15 (ms)', 'evaluations'))
+
+    for num_states in [10, 20, 50, 100, 200, 500, 1000, 5000]:
+        grph, states = synthetic_graph(num_states)
+        history = [ states[0] ]
+        prblm = problem.FindStateProblem(grph.state_to_key(states[-1]))
+
+        # DepthFirstSearch looks at paths of up to 3 behaviors
+        dfs_time, dfs_result = measure(search.DepthFirstSearch(), grph, history, prblm)
+        bfs_time, bfs_result = measure(search.BestFirstSearch(3), grph, history, prblm)
+        deep_time, deep_result = measure(search.BestFirstSearch(15), grph, history, prblm)
+
+        print('%8d %12.2f %12.2f %12.2f %12s' % (num_states,
+            dfs_time * 1e3, bfs_time * 1e3, deep_time * 1e3,
+            '%s/%s/%s' % (dfs_result[1], bfs_result[1], deep_result[1])))
+
+    print('')
+    print('Random walk search, 1000 states, 20000 walks per behavior')
+    print('%8s %12s %12s' % ('workers', 'time (ms)', 'speedup'))
+
+    grph, states = synthetic_graph(1000)
+    history = [ states[0] ]
+    prblm = problem.FindStateProblem(grph.state_to_key(states[-1]))
+
+    serial_time = None
+    for workers in range(1, multiprocessing.cpu_count() + 1):
+        srch = search.RandomWalkSearch(walks_per_behavior=20000, seed=0, workers=workers)
+        try:
+            # The first decision starts the worker processes
+            measure(srch, grph, history, prblm, repeat=1)
+            walk_time, walk_result = measure(srch, grph, history, prblm)
+        finally:
+            srch.close()
+
+        if serial_time is None:
+            serial_time = walk_time
+        print('%8d %12.2f %12.2f' % (workers, walk_time * 1e3, serial_time / walk_time))
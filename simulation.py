@@ -0,0 +1,469 @@
+import sys, os, math, random, time, threading
+from collections import deque
+from util import avg, isOverEdge, SensorSnapshot
+
+# Millimetres per second of a motor target of 1, and the distance between the
+# wheels of the robot in millimetres
+SPEED = 0.32
+AXLE = 95.0
+RADIUS = 55.0
+
+# Position on the rim and beam direction (radians, counter clockwise from
+# the heading) of the horizontal proximity sensors, five in front from left
+# to right and two at the rear looking straight back
+FRONT_SENSORS = [ (math.radians(a), math.radians(a)) for a in [40, 20, 0, -20, -40] ]
+REAR_SENSORS = [ (math.radians(a), math.pi) for a in [160, -160] ]
+PROX_RANGE = 120.0
+PROX_MAX = 4500
+
+# Position (forward, left) of the two ground sensors relative to the centre
+GROUND_SENSORS = [ (45.0, 10.0), (45.0, -10.0) ]
+GROUND_AMBIENT = 20
+OFF_TABLE = 50
+
+# Length of the lasso rope, from the rear of the robot to an object's edge
+ROPE = 60.0
+
+# Time step of the motion simulation in seconds
+STEP = 0.01
+
+class VirtualClock():
+    '''
+    Simulated time, sleeping advances it without waiting
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, amount):
+        self.now += amount
+
+
+class SimObject():
+    '''
+    A round object standing in the arena
+    '''
+
+    def __init__(self, x, y, radius, movable):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.movable = movable
+
+
+class Arena():
+    '''
+    A rectangular table of width x height millimetres with objects standing
+    on it and coloured patches on its surface. The ground colour is given as
+    the ground sensor delta it produces (see util.isRed and util.isGreen),
+    off the table the delta drops below the edge threshold.
+    '''
+
+    def __init__(self, width=1000.0, height=800.0, floor=800):
+        self.width = width
+        self.height = height
+        self.floor = floor
+        self.objects = []
+        self.patches = [] # (x, y, radius, delta)
+
+    def addObject(self, x, y, radius=30.0, movable=True):
+        obj = SimObject(x, y, radius, movable)
+        self.objects.append(obj)
+        return obj
+
+    def addPatch(self, x, y, radius, delta):
+        self.patches.append( (x, y, radius, delta) )
+
+    def ground(self, x, y):
+        '''
+        Get the ground sensor delta at the given point
+        '''
+        if x < 0 or y < 0 or x > self.width or y > self.height:
+            return OFF_TABLE
+        for px, py, radius, delta in self.patches:
+            if (x - px)**2 + (y - py)**2 <= radius**2:
+                return delta
+        return self.floor
+
+
+def randomArena(seed=None, objects=4, obstacles=2, patches=2):
+    '''
+    An arena with movable objects, fixed obstacles and red and green patches
+    at random places
+    '''
+    rng = random.Random(seed)
+    arena = Arena()
+    margin = 150.0
+    def place():
+        return (rng.uniform(margin, arena.width - margin),
+                rng.uniform(margin, arena.height - margin))
+
+    for i in range(patches):
+        x, y = place()
+        arena.addPatch(x, y, rng.uniform(60, 120), rng.choice([640, 950]))
+    for i in range(objects):
+        x, y = place()
+        arena.addObject(x, y, rng.uniform(20, 40), True)
+    for i in range(obstacles):
+        x, y = place()
+        arena.addObject(x, y, rng.uniform(40, 60), False)
+    return arena
+
+
+class Done():
+    '''
+    Handle of a simulated motion, which is over by the time it is returned
+    '''
+
+    def done(self):
+        return True
+
+    def wait(self, timeout=None):
+        return True
+
+    def cancel(self):
+        pass
+
+    def then(self, callback):
+        callback(self)
+
+
+class SimulatedSampler():
+    '''
+    Sensor sampler of a SimulatedThymio, with the interface of
+    thymio_api.SensorSampler. There is no background thread: the robot takes
+    a sample every period of simulated time while it moves and one after
+    every motion or sleep, so samples are stamped with the virtual time.
+    '''
+
+    def __init__(self, robot, rate=50, size=256):
+        self.robot = robot
+        self.period = 1.0 / rate
+        self.buffer = deque(maxlen=size) # (time, SensorSnapshot)
+        self.latest = None
+        self.sampled = None
+        self.error = None
+        self.overEdge = threading.Event()
+        self.ready = threading.Event()
+
+    def sample(self, t):
+        '''
+        Take a sample at the given virtual time
+        '''
+        snapshot = self.robot.fetchSnapshot()
+        if isOverEdge(snapshot.groundDelta):
+            self.overEdge.set()
+        else:
+            self.overEdge.clear()
+        self.latest = snapshot
+        self.sampled = t
+        self.buffer.append( (t, snapshot) )
+        self.ready.set()
+
+    def tick(self, t):
+        '''
+        Take a sample if a period has passed since the latest one
+        '''
+        if t - self.sampled >= self.period:
+            self.sample(t)
+
+    def stale(self):
+        return False
+
+    def history(self):
+        '''
+        Get the buffered (time, snapshot) pairs, oldest first
+        '''
+        return list(self.buffer)
+
+    def stop(self):
+        pass
+
+
+class SimulatedThymio():
+    '''
+    A Thymio driving around an Arena on a VirtualClock, with the interface of
+    ThymioAPI used by Behaviors and PipelinedBehaviors. Motions are simulated
+    in steps of STEP seconds. Like the edge watchdog of the real robot, the
+    table edge stops a motion, just before the ground sensors would go over
+    it. Proximity readings get gaussian noise of the given standard
+    deviation.
+    '''
+
+    def __init__(self, arena=None, clock=None, seed=None, noise=50.0, x=None, y=None, heading=0.0):
+        self.arena = arena if arena is not None else randomArena(seed)
+        self.clock = clock if clock is not None else VirtualClock()
+        self.rng = random.Random(seed)
+        self.noise = noise
+        self.x = x if x is not None else self.arena.width / 2
+        self.y = y if y is not None else self.arena.height / 2
+        self.heading = heading
+        self.attached = None # The object held by the lasso
+        self.sampler = None
+
+    def proximity(self, sensors):
+        values = []
+        for position, beam in sensors:
+            sx = self.x + RADIUS * math.cos(self.heading + position)
+            sy = self.y + RADIUS * math.sin(self.heading + position)
+            dx, dy = math.cos(self.heading + beam), math.sin(self.heading + beam)
+
+            nearest = PROX_RANGE
+            for obj in self.arena.objects:
+                # Distance along the beam to the object's edge, if it is hit
+                ox, oy = obj.x - sx, obj.y - sy
+                along = ox * dx + oy * dy
+                across = ox**2 + oy**2 - along**2
+                if along < 0 or across > obj.radius**2:
+                    continue
+                nearest = min(nearest, max(0.0, along - math.sqrt(obj.radius**2 - across)))
+
+            if nearest >= PROX_RANGE:
+                values.append(0)
+            else:
+                value = PROX_MAX * (1 - nearest / PROX_RANGE) + self.rng.gauss(0, self.noise)
+                values.append(int(min(PROX_MAX, max(0, value))))
+        return values
+
+    def groundDelta(self, x=None, y=None, heading=None):
+        x = self.x if x is None else x
+        y = self.y if y is None else y
+        heading = self.heading if heading is None else heading
+        cos, sin = math.cos(heading), math.sin(heading)
+        return [ self.arena.ground(x + forward * cos - left * sin, y + forward * sin + left * cos)
+                for forward, left in GROUND_SENSORS ]
+
+    def getFrontSensors(self):
+        return self.proximity(FRONT_SENSORS)
+
+    def getRearSensors(self):
+        return self.proximity(REAR_SENSORS)
+
+    def getGroundSensors(self):
+        delta = self.groundDelta()
+        return (GROUND_AMBIENT, avg(delta) + GROUND_AMBIENT, avg(delta))
+
+    def overEdge(self):
+        return isOverEdge(self.groundDelta())
+
+    def getAccelerometer(self):
+        return [0, 0, 23]
+
+    def getMicIntensity(self):
+        return self.rng.randint(0, 10)
+
+    def startSampler(self, rate=50, size=256, timeout=5.0):
+        sampler = SimulatedSampler(self, rate, size)
+        sampler.sample(self.clock.time())
+        self.sampler = sampler
+
+    def stopSampler(self):
+        self.sampler = None
+
+    def snapshot(self):
+        '''
+        Read every sensor: the latest sample if the sampler is running,
+        otherwise a fresh snapshot
+        '''
+        if self.sampler is not None:
+            return self.sampler.latest
+        return self.fetchSnapshot()
+
+    def fetchSnapshot(self, parallel=True):
+        delta = self.groundDelta()
+        return SensorSnapshot(
+            frontSensors=self.getFrontSensors(),
+            rearSensors=self.getRearSensors(),
+            groundSensors=(GROUND_AMBIENT, avg(delta) + GROUND_AMBIENT, avg(delta)),
+            groundDelta=delta,
+            accelerometer=self.getAccelerometer(),
+            micIntensity=self.getMicIntensity())
+
+    def safe(self):
+        return not self.overEdge()
+
+    def stopMotors(self):
+        pass
+
+    def sleep(self, amount):
+        self.clock.sleep(amount)
+        if self.sampler is not None:
+            self.sampler.sample(self.clock.time())
+
+    def rear(self):
+        return (self.x - RADIUS * math.cos(self.heading),
+                self.y - RADIUS * math.sin(self.heading))
+
+    def step(self, left, right):
+        '''
+        Drive for one time step, returning False if the robot was stopped
+        '''
+        v = SPEED * (left + right) / 2.0
+        w = SPEED * (right - left) / AXLE
+        heading = self.heading + w * STEP
+        x = self.x + v * STEP * math.cos(heading)
+        y = self.y + v * STEP * math.sin(heading)
+
+        if isOverEdge(self.groundDelta(x, y, heading)):
+            return False
+
+        for obj in self.arena.objects:
+            if obj is self.attached:
+                continue
+            dx, dy = obj.x - x, obj.y - y
+            distance = math.sqrt(dx**2 + dy**2)
+            reach = RADIUS + obj.radius
+            if distance >= reach:
+                continue
+            if not obj.movable:
+                return False
+            # Push the object out of the way
+            if distance == 0:
+                dx, dy, distance = math.cos(heading), math.sin(heading), 1.0
+            obj.x = x + dx / distance * reach
+            obj.y = y + dy / distance * reach
+
+        self.x, self.y, self.heading = x, y, heading
+
+        if self.attached is not None:
+            # Drag the object at the end of the rope
+            rx, ry = self.rear()
+            obj = self.attached
+            dx, dy = obj.x - rx, obj.y - ry
+            distance = math.sqrt(dx**2 + dy**2)
+            if distance > ROPE + obj.radius:
+                obj.x = rx + dx / distance * (ROPE + obj.radius)
+                obj.y = ry + dy / distance * (ROPE + obj.radius)
+        return True
+
+    def moveAsync(self, left, right, amount):
+        duration = amount * 0.1
+        if self.safe():
+            start = self.clock.time()
+            t = 0.0
+            while t < duration and self.step(left, right):
+                t += STEP
+                if self.sampler is not None:
+                    self.sampler.tick(start + t)
+            self.clock.sleep(t)
+        if self.sampler is not None:
+            self.sampler.sample(self.clock.time())
+        return Done()
+
+    def move(self, left, right, amount):
+        self.moveAsync(left, right, amount)
+
+    def forward(self, amount):
+        self.move(500, 500, amount)
+
+    def backwards(self, amount):
+        self.move(-500, -500, amount)
+
+    def left(self, amount):
+        self.move(-500, 500, amount)
+
+    def right(self, amount):
+        self.move(500, -500, amount)
+
+    def forwardAsync(self, amount):
+        return self.moveAsync(500, 500, amount)
+
+    def backwardsAsync(self, amount):
+        return self.moveAsync(-500, -500, amount)
+
+    def leftAsync(self, amount):
+        return self.moveAsync(-500, 500, amount)
+
+    def rightAsync(self, amount):
+        return self.moveAsync(500, -500, amount)
+
+
+class SimulatedLasso():
+    '''
+    The lasso of a SimulatedThymio, with the interface of lasso.Lasso. Going
+    down catches the nearest movable object within reach of the rope behind
+    the robot, going up lets it go.
+    '''
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.state = "up"
+
+    def cycle(self):
+        self.robot.clock.sleep(0.5)
+
+    def up(self):
+        self.state = "up"
+        self.robot.attached = None
+        self.cycle()
+
+    def down(self):
+        self.state = "down"
+        rx, ry = self.robot.rear()
+        nearest = None
+        for obj in self.robot.arena.objects:
+            distance = math.sqrt((obj.x - rx)**2 + (obj.y - ry)**2) - obj.radius
+            if obj.movable and distance <= ROPE and (nearest is None or distance < nearest[0]):
+                nearest = (distance, obj)
+        if nearest is not None:
+            self.robot.attached = nearest[1]
+        self.cycle()
+
+    def getState(self):
+        return self.state
+
+    def close(self):
+        pass
+
+
+def simulate(algorithm, rounds, arena=None, seed=None, noise=50.0, pipelined=False):
+    '''
+    Run an algorithm for the given number of behaviors on a simulated robot
+    in the given arena (a random one by default), with PipelinedBehaviors if
+    pipelined
+
+    returns: Behaviors
+    '''
+    from behaviors import Behaviors, PipelinedBehaviors
+    clock = VirtualClock()
+    robot = SimulatedThymio(arena, clock, seed, noise)
+    if pipelined:
+        behaviors = PipelinedBehaviors(robot, algorithm, lasso=SimulatedLasso(robot),
+                sleep=robot.sleep, clock=clock.time)
+    else:
+        behaviors = Behaviors(robot, algorithm, lasso=SimulatedLasso(robot), sleep=clock.sleep)
+    behaviors.run(rounds)
+    return behaviors
+
+
+# Application entry point
+if __name__ == '__main__':
+    from algorithms import SmartCollector
+    from discretization import SimplifyingDiscretizer
+    from graph import NullExporter
+
+    if len(sys.argv) < 2:
+        print('usage: python simulation.py <episodes> [rounds] [log file]')
+        sys.exit(1)
+    episodes = int(sys.argv[1])
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    logname = sys.argv[3] if len(sys.argv) > 3 else os.devnull
+    stdout = sys.stdout
+    with open(logname, 'a') as f:
+        for episode in range(episodes):
+            t = time.time()
+            random.seed(episode)
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                algorithm = SmartCollector(f, SimplifyingDiscretizer(), NullExporter())
+                behaviors = simulate(algorithm, rounds, seed=episode)
+                behaviors.algorithm.close()
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            print('episode %d: %d states, %.1f s simulated in %.2f s' % (episode,
+                len(behaviors.algorithm.graph.table), behaviors.robot.clock.time(),
+                time.time() - t))
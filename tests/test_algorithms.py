@@ -0,0 +1,48 @@
+import os, sys, random, unittest
+import numpy as np
+from algorithms import ProblemSolver
+from discretization import KMeansDiscretizer
+from graph import MarkovChainGraph
+from search import BestFirstSearch
+from problem import BallPickupProblem
+
+def sensor_state(rng):
+    return {
+        "frontSensors": [ rng.randint(0, 4500) for i in range(5) ],
+        "rearSensors": [ rng.randint(0, 4500) for i in range(2) ],
+        "groundSensors": (rng.randint(0, 1023), rng.randint(0, 1023), rng.randint(0, 1023)),
+        "accelerometer": [ rng.randint(-32, 32) for i in range(3) ],
+        "micIntensity": rng.randint(0, 255),
+        "lassoState": rng.choice(["up", "down"]),
+    }
+
+
+class ProblemSolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def test_action_state_is_in_graph(self):
+        rng = random.Random(0)
+        np.random.seed(0)
+        sensorStates = [ sensor_state(rng) for i in range(200) ]
+        behaviors = [ rng.choice(["explore", "faceObject", "tryGrab", "release"])
+                for i in range(200) ]
+        graph = MarkovChainGraph()
+        solver = ProblemSolver(KMeansDiscretizer(5), graph, BestFirstSearch(),
+                BallPickupProblem(), sensorStates, behaviors)
+        states = len(graph.table)
+
+        solver.action(sensorStates[0])
+        self.assertEqual(len(graph.table), states)
+        key = graph.state_to_key(solver.sensorStateHistory[-1])
+        self.assertIsNotNone(graph.table.lookup(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
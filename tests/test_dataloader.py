@@ -0,0 +1,45 @@
+import os, tempfile, unittest
+import dataloader
+
+STATE = ("{'frontSensors': [0, 0, 1200, 0, 0], 'rearSensors': [0, 0], "
+        "'groundSensors': (20, 820, 800), 'accelerometer': [0, 0, 23], "
+        "'micIntensity': 3, 'lassoState': 'up'}")
+
+class IterLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def load(self, lines):
+        with open(self.filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        errors = []
+        pairs = list(dataloader.iter_load(self.filename,
+                lambda i, line, error: errors.append(i)))
+        return pairs, errors
+
+    def test_valid_state(self):
+        pairs, errors = self.load([ STATE, 'explore' ])
+        self.assertEqual(errors, [])
+        self.assertEqual(pairs[0][0]['groundSensors'], (20, 820, 800))
+        self.assertEqual(pairs[0][1], 'explore')
+
+    def test_truncated_state_is_skipped(self):
+        truncated = "{'frontSensors': [0, 0, 1200, 0, 0], 'lassoState': 'up'}"
+        pairs, errors = self.load([ truncated, 'explore', STATE, 'release' ])
+        self.assertEqual(errors, [1])
+        self.assertEqual([ behavior for _, behavior in pairs ], [ 'release' ])
+
+    def test_wrong_length_is_skipped(self):
+        short = STATE.replace('[0, 0, 1200, 0, 0]', '[0, 0, 1200]')
+        pairs, errors = self.load([ short, 'explore' ])
+        self.assertEqual(errors, [1])
+        self.assertEqual(pairs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
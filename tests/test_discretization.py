@@ -0,0 +1,38 @@
+import os, shutil, tempfile, unittest
+import numpy as np
+from discretization import DiscretizerCache
+
+class DiscretizerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_get(self):
+        cache = DiscretizerCache(self.directory)
+        cache.put('a', np.arange(6.0).reshape(3, 2))
+        np.testing.assert_array_equal(cache.get('a'), np.arange(6.0).reshape(3, 2))
+        self.assertIsNone(cache.get('b'))
+
+    def test_eviction_keeps_the_new_model(self):
+        # Room for about two of these models
+        cache = DiscretizerCache(self.directory, max_bytes=2000)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, np.zeros(100))
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_oversized_model_is_not_cached(self):
+        cache = DiscretizerCache(self.directory, max_bytes=2000)
+        cache.put('small', np.zeros(10))
+        cache.put('large', np.zeros(1000))
+        self.assertIsNone(cache.get('large'))
+        self.assertIsNotNone(cache.get('small'))
+        self.assertEqual([ name for name in os.listdir(self.directory)
+                if not name.endswith('.npy') ], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
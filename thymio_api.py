@@ -4,11 +4,168 @@ import dbus.mainloop.glib
 import gobject
 import sys
 import time
-from util import avg
+import threading
+import Queue
+from collections import deque
+from util import avg, isOverEdge, SensorSnapshot
 
 def intArr(dbusArr):
     return map(lambda x: x*1, dbusArr)
 
+# The Aseba variables making up a snapshot
+SNAPSHOT_VARIABLES = ["prox.horizontal", "prox.ground.ambiant",
+        "prox.ground.reflected", "prox.ground.delta", "acc", "mic.intensity"]
+
+class SensorSampler(threading.Thread):
+    '''
+    Background thread reading a snapshot of the robot's sensors at a fixed
+    rate into a ring buffer of the last size snapshots, the latest one being
+    at hand for the control loop. It doubles as an edge watchdog: as soon as
+    a snapshot shows the robot over an edge the motors are stopped and the
+    overEdge event is set, until the robot is back on safe ground.
+
+    Failed reads are reported and retried. Without a sample for more than
+    stale periods the robot is treated as over an edge too, since nothing
+    is known about where it is.
+    '''
+
+    def __init__(self, robot, rate=50, size=256, stale=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.robot = robot
+        self.period = 1.0 / rate
+        self.stale_after = stale * self.period
+        self.buffer = deque(maxlen=size) # (time, SensorSnapshot)
+        self.latest = None
+        self.sampled = time.time()  # Time of the latest sample
+        self.error = None           # Error of the latest failed read
+        self.overEdge = threading.Event()
+        self.ready = threading.Event()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            t = time.time()
+            try:
+                # The main thread owns the GLib main context, so read synchronously
+                snapshot = self.robot.fetchSnapshot(parallel=False)
+            except Exception as e:
+                if self.error is None:
+                    sys.stderr.write('sensor sampler: failed reading the sensors: %s\n' % e)
+                self.error = e
+                snapshot = None
+
+            if snapshot is None:
+                if self.stale():
+                    self.halt()
+            else:
+                self.error = None
+                if isOverEdge(snapshot.groundDelta):
+                    self.halt()
+                else:
+                    self.overEdge.clear()
+
+                self.latest = snapshot
+                self.sampled = t
+                self.buffer.append( (t, snapshot) )
+                self.ready.set()
+
+            time.sleep(max(0, self.period - (time.time() - t)))
+
+    def stale(self):
+        '''
+        Whether the latest sample is too old to be trusted
+        '''
+        return time.time() - self.sampled > self.stale_after
+
+    def halt(self):
+        if self.overEdge.is_set():
+            return
+        self.overEdge.set()
+        try:
+            self.robot.stopMotors()
+        except Exception as e:
+            sys.stderr.write('sensor sampler: failed stopping the motors: %s\n' % e)
+
+    def history(self):
+        '''
+        Get the buffered (time, snapshot) pairs, oldest first
+        '''
+        return list(self.buffer)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class Motion():
+    '''
+    Handle of a motion command issued with ThymioAPI.moveAsync. Motions are
+    executed one after another, in the order they were issued, by the motion
+    thread of the robot, while the caller carries on. An error raised while
+    executing the motion or by one of its callbacks is kept in error and
+    raised again by wait.
+    '''
+
+    def __init__(self, left, right, duration):
+        self.left = left
+        self.right = right
+        self.duration = duration
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+        self.completed = False
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the motion to finish, returning whether it did, and raise
+        the error of the motion if it failed
+        '''
+        self.finished.wait(timeout)
+        if self.finished.is_set() and self.error is not None:
+            raise self.error
+        return self.finished.is_set()
+
+    def cancel(self):
+        '''
+        Skip the motion if it has not started yet, otherwise stop it early
+        '''
+        self.cancelled.set()
+
+    def then(self, callback):
+        '''
+        Call callback with this motion once it finishes (right away if it
+        already has). Callbacks run on the motion thread, so issuing the next
+        motion from one chains it without a gap.
+        '''
+        with self.lock:
+            if not self.completed:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, error=None):
+        '''
+        Mark the motion finished, after running its callbacks
+        '''
+        with self.lock:
+            self.completed = True
+            callbacks, self.callbacks = self.callbacks, []
+        self.error = error
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+        self.finished.set()
+
+
 class ThymioAPI:
     def __init__(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -18,11 +175,43 @@ class ThymioAPI:
         #Create Aseba network 
         self.network = dbus.Interface(bus.get_object('ch.epfl.mobots.Aseba', '/'), dbus_interface='ch.epfl.mobots.AsebaNetwork')
 
+        self.sampler = None
+        self.motions = None
+
+    def initThreads(self):
+        # D-Bus calls are made from background threads from now on
+        gobject.threads_init()
+        dbus.mainloop.glib.threads_init()
+
+    def startSampler(self, rate=50, size=256, timeout=5.0):
+        '''
+        Start sampling the sensors in the background. From then on sensor
+        reads are served from the latest sample and edge safety is enforced
+        by the sampler's watchdog. Raises if no sample is read within
+        timeout seconds.
+        '''
+        self.initThreads()
+        sampler = SensorSampler(self, rate, size)
+        sampler.start()
+        if not sampler.ready.wait(timeout):
+            sampler.stop()
+            raise Exception('No sensor reading within %.1f s: %s' % (timeout, sampler.error))
+        self.sampler = sampler
+
+    def stopSampler(self):
+        if self.sampler is not None:
+            sampler, self.sampler = self.sampler, None
+            sampler.stop()
+
     def getFrontSensors(self):
+        if self.sampler is not None:
+            return self.sampler.latest.frontSensors
         #get the values of the sensors
         return intArr(self.network.GetVariable("thymio-II", "prox.horizontal"))[:5]
 
     def getRearSensors(self):
+        if self.sampler is not None:
+            return self.sampler.latest.rearSensors
         return intArr(self.network.GetVariable("thymio-II", "prox.horizontal"))[5:7]
 
 
@@ -30,14 +219,18 @@ class ThymioAPI:
     # prox.ground.reflected : amount of light received when the sensor emits infrared, varies between 0 (no reflected light) and 1023 (maximum reflected light)
     # prox.ground.delta : difference between reflected light and ambient light, linked to the distance and to the ground colour.
     def getGroundSensors(self):
+        if self.sampler is not None:
+            return self.sampler.latest.groundSensors
         ambient = self.network.GetVariable("thymio-II", "prox.ground.ambiant")
         reflected = self.network.GetVariable("thymio-II", "prox.ground.reflected")
         delta = self.network.GetVariable("thymio-II", "prox.ground.delta")
         return (avg(ambient), avg(reflected), avg(delta))
 
     def overEdge(self):
+        if self.sampler is not None:
+            return self.sampler.overEdge.is_set() or self.sampler.stale()
         delta = self.network.GetVariable("thymio-II", "prox.ground.delta")
-        return delta[0] < 300 and delta[1] < 300
+        return isOverEdge(delta)
     
     # acc[0] : x-axis (from right to left, positive towards left)
     # acc[1] : y-axis (from front to back, positive towards the rear)
@@ -46,15 +239,83 @@ class ThymioAPI:
     # (the acceleration of the earth's gravity) corresponding to the value 23. 
     # Thymio updates this array at a frequency of 16 Hz, 
     def getAccelerometer(self):
+        if self.sampler is not None:
+            return self.sampler.latest.accelerometer
         return intArr(self.network.GetVariable("thymio-II", "acc"))
 
     def getMicIntensity(self):
+        if self.sampler is not None:
+            return self.sampler.latest.micIntensity
         return self.network.GetVariable("thymio-II", "mic.intensity")[0]*1
 
+    def getVariables(self, names, parallel=True):
+        '''
+        Fetch several Aseba variables at once: all GetVariable calls are
+        issued asynchronously and the replies collected from the GLib main
+        context, so the round trips overlap instead of adding up. Without
+        parallel the variables are fetched one by one.
+        '''
+        if not parallel:
+            return dict( (name, self.network.GetVariable("thymio-II", name)) for name in names )
+
+        replies = {}
+        errors = []
+
+        def replyHandler(name):
+            def handler(value):
+                replies[name] = value
+            return handler
+
+        for name in names:
+            self.network.GetVariable("thymio-II", name,
+                    reply_handler=replyHandler(name), error_handler=errors.append)
+
+        context = gobject.main_context_default()
+        while len(replies) + len(errors) < len(names):
+            context.iteration(True)
+
+        if len(errors) > 0:
+            raise errors[0]
+        return replies
+
+    def snapshot(self):
+        '''
+        Read every sensor: the latest sample if the sampler is running,
+        otherwise a fresh snapshot
+        '''
+        if self.sampler is not None:
+            return self.sampler.latest
+        return self.fetchSnapshot()
+
+    def fetchSnapshot(self, parallel=True):
+        '''
+        Read every sensor, fetching each Aseba variable exactly once
+        '''
+        values = self.getVariables(SNAPSHOT_VARIABLES, parallel)
+        horizontal = intArr(values["prox.horizontal"])
+        delta = values["prox.ground.delta"]
+        return SensorSnapshot(
+            frontSensors=horizontal[:5],
+            rearSensors=horizontal[5:7],
+            groundSensors=(avg(values["prox.ground.ambiant"]),
+                avg(values["prox.ground.reflected"]), avg(delta)),
+            groundDelta=intArr(delta),
+            accelerometer=intArr(values["acc"]),
+            micIntensity=values["mic.intensity"][0]*1)
+
     def safe(self):
         return not self.overEdge()
 
+    def stopMotors(self):
+        self.network.SetVariable("thymio-II", "motor.left.target", [0])
+        self.network.SetVariable("thymio-II", "motor.right.target", [0])
+
     def sleep(self, amount):
+        if self.sampler is not None:
+            # Returns early when the watchdog sees an edge
+            self.sampler.overEdge.wait(amount)
+            return
+
         d = 0.01
         t = 0
         while t < amount:
@@ -62,13 +323,57 @@ class ThymioAPI:
                 return
             time.sleep(d)
             t += d
+    def moveAsync(self, left, right, amount):
+        '''
+        Queue a motion on the motion thread and return its Motion handle
+        without waiting for it
+        '''
+        if self.motions is None:
+            self.initThreads()
+            self.motions = Queue.Queue()
+            worker = threading.Thread(target=self.motionLoop)
+            worker.daemon = True
+            worker.start()
+
+        motion = Motion(left, right, amount*0.1)
+        self.motions.put(motion)
+        return motion
+
+    def motionLoop(self):
+        while True:
+            motion = self.motions.get()
+            # A failing motion must not take the motion thread down with it
+            try:
+                self.execute(motion)
+            except Exception as e:
+                motion.finish(e)
+            else:
+                motion.finish()
+
+    def execute(self, motion):
+        if motion.cancelled.is_set() or not self.safe():
+            return
+
+        try:
+            self.network.SetVariable("thymio-II", "motor.left.target", [motion.left])
+            self.network.SetVariable("thymio-II", "motor.right.target", [motion.right])
+            deadline = time.time() + motion.duration
+            while not motion.cancelled.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if self.sampler is not None:
+                    # The watchdog stops the motors at an edge, stop waiting too
+                    if self.overEdge():
+                        break
+                    motion.cancelled.wait(min(remaining, 0.01))
+                else:
+                    motion.cancelled.wait(remaining)
+        finally:
+            self.stopMotors()
+
     def move(self, left, right, amount):
-        if self.safe():
-            self.network.SetVariable("thymio-II", "motor.left.target", [left])
-            self.network.SetVariable("thymio-II", "motor.right.target", [right])
-            time.sleep(amount*0.1)
-            self.network.SetVariable("thymio-II", "motor.left.target", [0])
-            self.network.SetVariable("thymio-II", "motor.right.target", [0])
+        self.moveAsync(left, right, amount).wait()
 
     def forward(self, amount):
         self.move(500, 500, amount)
@@ -81,3 +386,15 @@ class ThymioAPI:
 
     def right(self, amount):
         self.move(500, -500, amount)
+
+    def forwardAsync(self, amount):
+        return self.moveAsync(500, 500, amount)
+
+    def backwardsAsync(self, amount):
+        return self.moveAsync(-500, -500, amount)
+
+    def leftAsync(self, amount):
+        return self.moveAsync(-500, 500, amount)
+
+    def rightAsync(self, amount):
+        return self.moveAsync(500, -500, amount)
@@ -1,3 +1,9 @@
+from collections import namedtuple
+
+# A reading of every sensor of the robot, fetched in one round of D-Bus calls
+SensorSnapshot = namedtuple('SensorSnapshot', ['frontSensors', 'rearSensors',
+    'groundSensors', 'groundDelta', 'accelerometer', 'micIntensity'])
+
 
 def avg(l):
     return sum(l) / len(l)
@@ -10,3 +16,6 @@ def isGreen(a):
 
 def isGround(a):
     return not isRed(a) and not isYellow(a)
+
+def isOverEdge(delta):
+    return delta[0] < 300 and delta[1] < 300